@@ -0,0 +1,103 @@
+"""Compares per frame cost of audiosource gain stages with PCMVolumeTransformer
+
+Run from the repository root:
+    python benchmarks/gain.py
+"""
+
+import os
+import sys
+import timeit
+import audioop
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+import numpy as np  # noqa: E402
+
+from musicbot.audiosource import GainTransformer, SongSource  # noqa: E402
+
+# a frame of loud noise
+FRAME = (
+    (np.random.default_rng(0).standard_normal(1920) * 8000)
+    .clip(-32768, 32767)
+    .astype(np.int16)
+    .tobytes()
+)
+
+
+class Frames(discord.AudioSource):
+    "Plays the same frame forever"
+
+    def read(self):
+        return FRAME
+
+
+class FakeSong(SongSource):
+    "Song that doesn't start ffmpeg"
+
+    def _open(self, volume, position):
+        return GainTransformer(Frames(), volume)
+
+
+def ramping(source):
+    "Changes volume on every frame"
+
+    def read():
+        source.volume = 0.5 if source.volume == 0.6 else 0.6
+        source.read()
+
+    return read
+
+
+def mixing():
+    "Mixes two songs, changing their volumes on every frame"
+    first = discord.PCMVolumeTransformer(Frames(), 1.0)
+    second = discord.PCMVolumeTransformer(Frames(), 0.0)
+
+    def read():
+        first.volume = 1 - first.volume
+        second.volume = 1 - second.volume
+        audioop.add(first.read(), second.read(), 2)
+
+    return read
+
+
+def crossfading():
+    "Reads a 1 second crossfade of two songs, restarting it when done"
+    song = FakeSong("", None, 1.0)
+
+    def read():
+        nonlocal song
+        if not song._fade_frames:
+            song = FakeSong("", None, 1.0)
+            song.fade_from(FakeSong("", None, 1.0), 1)
+        song.read()
+
+    return read
+
+
+def main():
+    cases = [
+        (
+            "steady volume",
+            discord.PCMVolumeTransformer(Frames(), 0.5).read,
+            GainTransformer(Frames(), 0.5).read,
+        ),
+        (
+            "volume change",
+            ramping(discord.PCMVolumeTransformer(Frames(), 0.5)),
+            ramping(GainTransformer(Frames(), 0.5)),
+        ),
+        ("crossfade", mixing(), crossfading()),
+    ]
+    print(f"{'':<16} {'audioop':>9} {'numpy':>9}")
+    for name, old, new in cases:
+        times = [
+            min(timeit.repeat(f, number=1000, repeat=5)) / 1000
+            for f in (old, new)
+        ]
+        print(f"{name:<16}", *(f"{t * 1e6:7.1f}us" for t in times))
+
+
+if __name__ == "__main__":
+    main()
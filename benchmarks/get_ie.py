@@ -0,0 +1,56 @@
+"""Compares linkutils.get_ie with a scan over all extractors
+
+Run from the repository root:
+    python benchmarks/get_ie.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from musicbot.linkutils import EXTRACTORS, get_ie, get_ie_index  # noqa: E402
+
+URLS = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?si=abc",
+    "https://www.youtube.com/playlist?list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSK",
+    "https://music.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://soundcloud.com/artist/track",
+    "https://artist.bandcamp.com/track/song",
+    "https://www.twitch.tv/videos/123456789",
+    "https://vimeo.com/123456",
+    "https://www.dailymotion.com/video/x7tgad0",
+    "https://cdn.discordapp.com/attachments/1/2/song.mp3",
+    "https://example.com/page.html",
+    "https://en.wikipedia.org/wiki/Music",
+]
+
+
+def scan(url):
+    for ie in EXTRACTORS:
+        if ie.suitable(url) and ie.IE_NAME != "generic":
+            return ie
+    return None
+
+
+def main():
+    build = timeit.timeit(get_ie_index, number=1)
+    print(f"index built in {build * 1000:.0f} ms,", end=" ")
+    print(f"{len(get_ie_index().fallback)} extractors not indexed")
+    # compile patterns of all extractors before measuring
+    for url in URLS:
+        assert scan(url) is get_ie.__wrapped__(url), url
+
+    print(f"{'':>60} {'scan':>9} {'index':>9} {'cached':>9}")
+    for url in URLS:
+        times = [
+            min(timeit.repeat(lambda: f(url), number=20, repeat=5)) / 20
+            for f in (scan, get_ie.__wrapped__, get_ie)
+        ]
+        print(f"{url[:60]:<60}", *(f"{t * 1e6:7.1f}us" for t in times))
+
+
+if __name__ == "__main__":
+    main()
@@ -46,8 +46,38 @@ class Config:
 
     # maximum of 25
     MAX_SONG_PRELOAD = 5
+    # send audio at full volume without decoding it, saves a lot of CPU
+    OPUS_PASSTHROUGH = True
+    # seconds over which songs fade into the next one, 0 to cut
+    CROSSFADE = 0
+    # seconds before the end of a song when the next one is opened,
+    # so it starts without a gap, 0 to open it when the song ends
+    GAPLESS_LEAD = 5
+    # ffmpeg processes of each kind started in advance, so songs
+    # don't wait for ffmpeg to load, 0 to start it when they do
+    FFMPEG_POOL_SIZE = 2
+    # ffmpeg processes running at once, songs wait for one to end
+    # when there are this many, 0 for no limit
+    MAX_DECODERS = 0
+    # soften peaks of overlapping songs instead of clipping them
+    SOFT_LIMITER = True
     # how many results to display in d!search
     SEARCH_RESULTS = 5
+    # seconds before expiration when stream URLs of queued songs are refreshed
+    STREAM_REFRESH_MARGIN = 1800
+    # maximum number of stream URLs refreshed every 30 seconds
+    STREAM_REFRESH_LIMIT = 10
+    # how many playlist songs are extracted at once
+    PLAYLIST_CHUNK_SIZE = 50
+    # the next songs of a playlist are extracted when fewer than this
+    # are queued, 0 to load whole playlists at once
+    PLAYLIST_LOOKAHEAD = 100
+    # how many songs of a queued playlist are loaded simultaneously
+    PLAYLIST_RESOLVE_CONCURRENCY = 4
+    # seconds user requests can wait for a free extraction worker
+    REQUEST_DEADLINE = 300
+    # seconds play waits for the song before replying that it's still loading
+    LOAD_REPLY_TIMEOUT = 3
 
     MAX_HISTORY_LENGTH = 10
     MAX_TRACKNAME_HISTORY_LENGTH = 15
@@ -78,6 +108,77 @@ class Config:
 
     COOKIE_PATH = "config/cookies/cookies.txt"
 
+    # how many songs can be extracted simultaneously
+    EXTRACTION_WORKERS = 2
+    # use threads instead of processes for extraction
+    # uses less memory, but CPU-heavy extractions may slow the bot down
+    EXTRACTION_USE_THREADS = False
+    # workers that background preloads leave free for user requests
+    RESERVED_EXTRACTION_WORKERS = 1
+    # how many extractions one guild can run at once, 0 for no limit
+    # the song about to play is never held back
+    MAX_GUILD_EXTRACTIONS = 0
+    # how many simultaneous extractions are allowed for one site
+    MAX_SITE_EXTRACTIONS = 2
+    # per-site overrides of the above, for example {"youtube": 3}
+    SITE_EXTRACTION_LIMITS = {}
+    # seconds after which an extraction is aborted and its worker restarted
+    EXTRACTION_TIMEOUT = 60
+    # same for playlist pages after the first one, extracted entry by entry
+    PLAYLIST_EXTRACTION_TIMEOUT = 600
+    # restart workers after this many jobs to free memory, 0 to disable
+    WORKER_MAX_JOBS = 500
+    # restart worker processes using more megabytes of memory, 0 to disable
+    WORKER_MAX_MEMORY = 512
+    # start a copy of a song extraction the user waits for on another worker
+    # when it runs longer than this percentile of recent extractions
+    # from the same site, 0 to disable
+    HEDGE_PERCENTILE = 95
+    # maximum share of extractions that can be copied
+    HEDGE_BUDGET = 0.05
+    # how many extractions per second can be started for one site
+    # and how many of them at once after a quiet period
+    SITE_REQUEST_RATE = 2
+    SITE_REQUEST_BURST = 5
+    # per-site overrides of the rate, for example {"youtube": 1}
+    SITE_REQUEST_RATES = {}
+    # seconds extractions from a site are paused when it throttles the bot
+    # doubled for every consecutive throttling up to the maximum
+    THROTTLE_BACKOFF = 5
+    THROTTLE_BACKOFF_MAX = 600
+    # consecutive throttlings after which extractions from the site
+    # fail without being tried until the pause ends
+    THROTTLE_CIRCUIT_BREAKER = 3
+
+    # directory for persistent caches
+    # set to empty string to keep caches in memory only
+    CACHE_DIR = "cache"
+    # how many songs are kept in memory cache
+    SONG_CACHE_SIZE = 1000
+    # how long song info is cached, in seconds
+    SONG_CACHE_TTL = 604800
+
+    # how many search queries are kept in memory cache
+    SEARCH_CACHE_SIZE = 500
+    # how long search results are cached, in seconds
+    SEARCH_CACHE_TTL = 86400
+
+    # how many links that failed to load are kept in memory cache
+    FAILURE_CACHE_SIZE = 1000
+    # how long failures are cached by their cause, in seconds
+    FAILURE_CACHE_TTLS = {
+        "unsupported": 86400,
+        "unavailable": 3600,
+        "network": 15,
+        "error": 300,
+    }
+
+    # megabytes of audio of often played songs saved in CACHE_DIR,
+    # 0 to always stream songs from their sites
+    AUDIO_CACHE_SIZE = 0
+    # how many times a song is played before it is saved
+    AUDIO_CACHE_MIN_PLAYS = 2
+
     GLOBAL_DISABLE_AUTOJOIN_VC = False
 
     # whether to tell users the bot is disconnecting
@@ -1,4 +1,10 @@
+import os
+import sys
+
 __all__ = ("loader",)
 
+# to load yt-dlp plugin, before anything imports yt-dlp
+sys.path.append(os.path.dirname(__file__))
+
 # avoid circular import error
 from . import loader
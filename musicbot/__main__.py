@@ -1,4 +1,3 @@
-import os
 import sys
 from traceback import print_exc
 
@@ -11,10 +10,6 @@ from musicbot.bot import MusicBot
 from musicbot.utils import check_dependencies, read_shutdown
 
 
-# to load yt-dlp plugin
-sys.path.append(os.path.dirname(__file__))
-
-
 initial_extensions = [
     "musicbot.commands.music",
     "musicbot.commands.general",
@@ -56,7 +51,7 @@ if __name__ == "__main__":
     bot.load_extensions(*initial_extensions)
 
     # start executor before reading from stdin to avoid deadlocks
-    loader.init()
+    loader.init(bot)
 
     if "--run" in sys.argv:
         shutdown_task = bot.loop.create_task(read_shutdown())
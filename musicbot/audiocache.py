@@ -0,0 +1,214 @@
+"""Audio of popular songs stored on local disk as Ogg/Opus
+
+Files are named by extractor and video id, so different links to the
+same video share one. A song is saved in the background once it has
+been played AUDIO_CACHE_MIN_PLAYS times, least recently played files
+are deleted when the cache grows over AUDIO_CACHE_SIZE megabytes.
+"""
+
+import os
+import sys
+import math
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from config import config
+from musicbot import ffmpegpool
+from musicbot.song import Song
+from musicbot.cache import LRUCache
+from musicbot.linkutils import get_ie, normalize_url
+
+# how many songs have their plays counted
+PLAY_COUNT_SIZE = 10000
+# longer songs and live streams are never saved, in seconds
+MAX_DURATION = 1200
+BITRATE = "128k"
+
+# file sizes by key, least recently played first
+_files: "OrderedDict[str, int]" = OrderedDict()
+_size = 0
+_loaded = False
+_plays = LRUCache(PLAY_COUNT_SIZE)
+# songs being saved
+_filling: Dict[str, asyncio.Task] = {}
+# only one song is saved at a time
+_fill_lock: Optional[asyncio.Lock] = None
+_hits = 0
+_misses = 0
+
+
+def enabled() -> bool:
+    return bool(config.CACHE_DIR and config.AUDIO_CACHE_SIZE)
+
+
+def _directory() -> str:
+    return os.path.join(config.CACHE_DIR, "audio")
+
+
+def _path(key: str) -> str:
+    return os.path.join(_directory(), key + ".ogg")
+
+
+def _load():
+    "Reads the files left by previous runs"
+    global _loaded, _size
+    if _loaded:
+        return
+    _loaded = True
+    os.makedirs(_directory(), exist_ok=True)
+    files = []
+    for entry in os.scandir(_directory()):
+        name, ext = os.path.splitext(entry.name)
+        if ext == ".part":
+            # interrupted while saving
+            os.remove(entry.path)
+        elif ext == ".ogg":
+            stat = entry.stat()
+            files.append((stat.st_mtime, name, stat.st_size))
+    for _, key, size in sorted(files):
+        _files[key] = size
+        _size += size
+
+
+def _key(song: Song) -> Optional[str]:
+    if song.webpage_url is None:
+        return None
+    ie = get_ie(song.webpage_url)
+    if ie is None:
+        return None
+    song_id = ie.get_temp_id(song.webpage_url) or normalize_url(
+        song.webpage_url
+    )
+    return hashlib.sha1(f"{ie.ie_key()}:{song_id}".encode()).hexdigest()
+
+
+def lookup(song: Song) -> Optional[str]:
+    "Returns path to the saved audio of the song, if there is one"
+    global _hits, _misses
+    if not enabled():
+        return None
+    key = _key(song)
+    if key is None:
+        return None
+    _load()
+    if key not in _files:
+        _misses += 1
+        return None
+    _hits += 1
+    _files.move_to_end(key)
+    path = _path(key)
+    try:
+        # remember the order for the next run
+        os.utime(path)
+    except OSError:
+        pass
+    return path
+
+
+def played(song: Song):
+    """Counts a play of a song that wasn't saved
+    Starts saving it if it's played often enough"""
+    key = _key(song) if enabled() else None
+    if key is None:
+        return
+    _load()
+    item = _plays.get(key)
+    plays = (item[0] if item else 0) + 1
+    _plays.put(key, plays, math.inf)
+    if (
+        plays < config.AUDIO_CACHE_MIN_PLAYS
+        or key in _filling
+        or key in _files
+        or not song.url
+        or not song.duration
+        or song.duration > MAX_DURATION
+    ):
+        return
+    task = asyncio.ensure_future(_fill(key, song.url))
+    _filling[key] = task
+    task.add_done_callback(lambda _: _filling.pop(key, None))
+
+
+async def _fill(key: str, url: str):
+    global _fill_lock, _size
+    if _fill_lock is None:
+        _fill_lock = asyncio.Lock()
+    async with _fill_lock:
+        if not ffmpegpool.reserve():
+            # songs being played come first
+            return
+        path = _path(key)
+        part = path + ".part"
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg",
+                "-reconnect",
+                "1",
+                "-reconnect_streamed",
+                "1",
+                "-reconnect_delay_max",
+                "5",
+                "-i",
+                url,
+                "-vn",
+                "-c:a",
+                "libopus",
+                "-b:a",
+                BITRATE,
+                "-f",
+                "ogg",
+                "-loglevel",
+                "error",
+                "-y",
+                part,
+                stdin=asyncio.subprocess.DEVNULL,
+                stderr=sys.stderr,
+            )
+            code = await process.wait()
+        except asyncio.CancelledError:
+            if process is not None:
+                process.kill()
+                await process.wait()
+            raise
+        finally:
+            ffmpegpool.release()
+            if (
+                process is None or process.returncode != 0
+            ) and os.path.exists(part):
+                os.remove(part)
+        if code != 0:
+            return
+        os.replace(part, path)
+        size = os.path.getsize(path)
+        _files[key] = size
+        _size += size
+    _evict()
+
+
+def _evict():
+    global _size
+    limit = config.AUDIO_CACHE_SIZE * 2**20
+    for key in list(_files):
+        if _size <= limit:
+            break
+        try:
+            os.remove(_path(key))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # still playing on Windows
+            continue
+        _size -= _files.pop(key)
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "hits": _hits,
+        "misses": _misses,
+        "files": len(_files),
+        "size": f"{_size / 2**20:.0f} MB",
+        "saving": len(_filling),
+    }
@@ -1,15 +1,28 @@
 import sys
+import time
 import asyncio
 from itertools import islice
 from inspect import isawaitable
 from traceback import print_exc
-from typing import TYPE_CHECKING, Coroutine, Literal, Optional, Union
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Coroutine,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import discord
 from config import config
 
-from musicbot import loader, utils
+from musicbot import audiocache, ffmpegpool, loader, utils
 from musicbot.song import Song
+from musicbot.audiosource import Playback, SongSource
 from musicbot.playlist import Playlist, LoopMode, LoopState, PauseState
 from musicbot.utils import CheckError, asset, play_check
 
@@ -19,11 +32,24 @@ if TYPE_CHECKING:
 
 
 VC_CONNECT_TIMEOUT = 10
+# seconds between playlist loading progress updates
+PROGRESS_INTERVAL = 5
+# assumed for songs with unknown duration
+AVERAGE_SONG_DURATION = 240
 
 PLAYLIST = object()
 _not_provided = object()
 
 
+async def _next_chunk(
+    stream: AsyncIterator[Union[Song, List[Song]]]
+) -> Optional[Union[Song, List[Song]]]:
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
 class MusicButton(discord.ui.Button):
     def __init__(self, callback, check=play_check, **kwargs):
         super().__init__(**kwargs)
@@ -73,6 +99,19 @@ class AudioController(object):
         # according to Python documentation, we need
         # to keep strong references to all tasks
         self._tasks = set()
+        # tasks loading songs, cancelled when the songs are removed
+        self._loading: Dict[Song, set] = {}
+        # tasks queuing playlists and reporting their progress,
+        # cancelled when the player is stopped
+        self._streams = set()
+        # set when songs may have left the queue
+        self._queue_changed = asyncio.Event()
+        # starts the next song while the skipped one is still playing
+        self._switching: Optional[asyncio.Task] = None
+        # opens the next song before the current one ends
+        self._preparing: Optional[asyncio.Task] = None
+        # time.monotonic() when the last song ended, to time the gap
+        self._ended_at: Optional[float] = None
 
         self.message_lock = asyncio.Lock()
 
@@ -280,7 +319,20 @@ class AudioController(object):
         Plays the next song if there is one"""
 
         if self.is_active():
-            self._next_song = self.playlist.next(forced)
+            self.cancel_switch()
+            next_song = self.playlist.next(forced)
+            self.cancel_removed()
+            if (
+                config.CROSSFADE
+                and next_song
+                and self.guild.voice_client.is_playing()
+            ):
+                # keep playing until the next song can fade in
+                self._switching = self.add_task(
+                    self.play_song(next_song, fade=True)
+                )
+                return
+            self._next_song = next_song
             self.guild.voice_client.stop()
             return
 
@@ -288,13 +340,19 @@ class AudioController(object):
             self.playlist.add_name(self.current_song.title)
             self.current_song = None
 
+        if self._switching:
+            # the skipped song ended first, the next one is still loading
+            return
+
         if self._next_song:
             next_song = self._next_song
             self._next_song = None
         else:
             next_song = self.playlist.next(forced)
+            self.cancel_removed()
 
         if next_song is None:
+            self._ended_at = None
             if not self.timer.triggered and self.guild.voice_client:
                 self.add_task(
                     self.timer.start(
@@ -306,39 +364,62 @@ class AudioController(object):
                 )
             return
 
+        if self._ended_at is None:
+            self._ended_at = time.monotonic()
         coro = self.play_song(next_song)
         self.add_task(coro)
 
-    async def play_song(self, song: Song):
-        """Plays a song object"""
+    async def play_song(self, song: Song, fade: bool = False):
+        """Plays a song object
+        With `fade`, crossfades from the playing song if there is one"""
 
-        if not await loader.preload(song):
-            self.next_song(forced=True)
+        path = audiocache.lookup(song)
+        if path is None and not await self._load_stream(song):
+            return
+        await ffmpegpool.wait_reserve()
+        if not self.playlist.playque or self.playlist.playque[0] is not song:
+            # skipped or stopped while waiting for a decoder
+            ffmpegpool.release()
+            self._settle_switch()
             return
+        source = self._open_source(song, path)
 
-        if song.url is None:
-            print(
-                "Something is wrong."
-                " Refusing to play a song without direct url.",
-                file=sys.stderr,
+        self._settle_switch()
+        client = self.guild.voice_client
+        if fade and self.is_active():
+            self.playlist.add_name(self.current_song.title)
+            playback = client.source
+            playback.switch(source, config.CROSSFADE)
+        else:
+            playback = Playback(source, self._ended_at)
+            if not client.encoder:
+                # the player only makes one for sources that start as PCM,
+                # this one may switch to PCM later
+                client.encoder = discord.opus.Encoder()
+            # called from the player thread, the queue is only moved on
+            # in the event loop
+            client.play(
+                playback,
+                after=lambda e: self.bot.loop.call_soon_threadsafe(
+                    self.next_song, e
+                ),
             )
-            self.next_song(forced=True)
-            return
+        self._ended_at = None
 
         self.current_song = song
-
-        self.guild.voice_client.play(
-            discord.PCMVolumeTransformer(
-                discord.FFmpegPCMAudio(
-                    song.url,
-                    before_options="-reconnect 1 -reconnect_streamed 1"
-                    " -reconnect_delay_max 5",
-                    options="-loglevel error",
-                    stderr=sys.stderr,
-                ),
-                float(self.volume) / 100.0,
-            ),
-            after=self.next_song,
+        await self._song_started(song, playback, source)
+
+    async def _song_started(
+        self, song: Song, playback: Playback, source: SongSource
+    ):
+        "Announces the song and gets the next one ready"
+        if source.remote:
+            # songs opened but never played don't count
+            audiocache.played(song)
+        if self._preparing:
+            self._preparing.cancel()
+        self._preparing = self.add_task(
+            self._prepare_next(song, playback, source)
         )
 
         if (
@@ -351,25 +432,170 @@ class AudioController(object):
 
         self.preload_queue()
 
+    async def _load_stream(self, song: Song) -> bool:
+        "Loads the stream URL of the song, moves on if it can't be played"
+        loaded = False
+        try:
+            loaded = await self.preload(song, priority=loader.Priority.NEXT)
+        except loader.ThrottledError as e:
+            # keep the song, next play command will try it again
+            self._ended_at = None
+            if self.command_channel:
+                await self.command_channel.send(e)
+            return False
+        finally:
+            if not loaded or song.url is None:
+                # it won't be played, the skipped song may end on its own
+                self._settle_switch()
+        if not loaded:
+            if song in self.playlist.playque:
+                self.next_song(forced=True)
+            # otherwise it was removed while loading
+            return False
+
+        if song.url is None:
+            print(
+                "Something is wrong."
+                " Refusing to play a song without direct url.",
+                file=sys.stderr,
+            )
+            self.next_song(forced=True)
+            return False
+        return True
+
+    def _open_source(self, song: Song, path: Optional[str]) -> SongSource:
+        """Opens the saved audio of the song at `path`, or its stream
+        A decoder slot must be reserved for it"""
+        volume = float(self.volume) / 100.0
+        if path is not None:
+            # saved songs don't need their stream URL
+            return SongSource(path, "opus", volume, remote=False)
+        return SongSource(song.url, song.acodec, volume)
+
+    async def _prepare_next(
+        self, song: Song, playback: Playback, source: SongSource
+    ):
+        """Opens the next song GAPLESS_LEAD seconds before the current one
+        ends, so that the player goes on with it without a gap,
+        or fades into it for the last CROSSFADE seconds"""
+        if not config.GAPLESS_LEAD or not song.duration:
+            return
+        lead = config.GAPLESS_LEAD + config.CROSSFADE
+        if not await self._wait_for_end(playback, source, song, lead):
+            return
+        next_song = self.playlist.peek_next()
+        if next_song is None:
+            return
+        path = audiocache.lookup(next_song)
+        if path is None:
+            try:
+                loaded = await self.preload(
+                    next_song, priority=loader.Priority.NEXT
+                )
+            except loader.ThrottledError:
+                return
+            if not loaded or next_song.url is None:
+                # dealt with when the current song ends
+                return
+        if (
+            playback.current is not source
+            or not self._is_next(next_song)
+            or not ffmpegpool.reserve()
+        ):
+            return
+        upcoming = self._open_source(next_song, path)
+        if not config.CROSSFADE:
+            playback.prepare(
+                upcoming,
+                lambda: self._hand_over(next_song, playback, upcoming),
+            )
+            return
+        if not (
+            await self._wait_for_end(
+                playback, source, song, config.CROSSFADE
+            )
+            and self._is_next(next_song)
+        ):
+            upcoming.cleanup()
+            return
+        playback.switch(upcoming, config.CROSSFADE)
+        self._handed_over(next_song, playback, upcoming)
+
+    async def _wait_for_end(
+        self, playback: Playback, source: SongSource, song: Song, lead: float
+    ) -> bool:
+        """Waits until the song has `lead` seconds left
+        Returns whether it is still playing"""
+        while True:
+            client = self.guild.voice_client
+            if (
+                client is None
+                or client.source is not playback
+                or playback.current is not source
+            ):
+                return False
+            remaining = song.duration - source.position - lead
+            if remaining <= 0:
+                return True
+            await asyncio.sleep(remaining)
+
+    def _is_next(self, song: Song) -> bool:
+        "Whether the song is played after the current one"
+        try:
+            return self.playlist.peek_next() is song
+        except IndexError:
+            # changed by another thread while looking
+            return False
+
+    def _hand_over(
+        self, song: Song, playback: Playback, source: SongSource
+    ) -> bool:
+        """Decides whether the player goes on with the song opened ahead
+        of time, it must still be next
+        Called from the player thread when the current song ends,
+        only reads the queue, which is moved on in the event loop"""
+        if not self._is_next(song):
+            return False
+        self.bot.loop.call_soon_threadsafe(
+            self._handed_over, song, playback, source
+        )
+        return True
+
+    def _handed_over(
+        self, song: Song, playback: Playback, source: SongSource
+    ):
+        "Moves the queue on to the song the player went on with"
+        client = self.guild.voice_client
+        if not self._is_next(song):
+            # the queue changed since, play what it says instead
+            if client and client.source is playback:
+                client.stop()
+            return
+        self.playlist.next()
+        if self.current_song:
+            self.playlist.add_name(self.current_song.title)
+        self.current_song = song
+        self.cancel_removed()
+        self.add_task(self._song_started(song, playback, source))
+
     async def process_song(
-        self, track: str
+        self, track: str, deadline: Optional[float] = None
     ) -> Union[Optional[Song], Literal[PLAYLIST]]:
         """Adds the track to the playlist instance
-        Starts playing if it is the first song"""
+        Starts playing if it is the first song
+        Playlists keep being queued in the background
+        Gives up if loading doesn't start before `deadline`"""
 
-        loaded_song = await loader.load_song(track)
+        stream = loader.iter_song(
+            track, guild=self.guild.id, deadline=deadline
+        )
+        loaded_song = await _next_chunk(stream)
         if not loaded_song:
             return None
         elif isinstance(loaded_song, Song):
             self.playlist.add(loaded_song)
         else:
-            for song in loaded_song:
-                self.playlist.add(song)
-            if len(loaded_song) == 1:
-                # special-case one-item playlists
-                loaded_song = loaded_song[0]
-            else:
-                loaded_song = PLAYLIST
+            self.add_songs(loaded_song)
 
         if self.current_song is None:
             print("Playing {}".format(track))
@@ -377,19 +603,126 @@ class AudioController(object):
         else:
             self.preload_queue()
 
-        return loaded_song
+        if isinstance(loaded_song, Song):
+            return loaded_song
 
-    def add_task(self, coro: Coroutine):
+        count = len(loaded_song)
+        if count == 1:
+            chunk = await _next_chunk(stream)
+            if chunk is None:
+                # special-case one-item playlists
+                return loaded_song[0]
+            self.add_songs(chunk)
+            count += len(chunk)
+        if stream.pending == 0:
+            # loaded at once, or its last page is already queued
+            return PLAYLIST
+        task = self.add_task(self._queue_stream(stream, count))
+        self._streams.add(task)
+        task.add_done_callback(self._streams.discard)
+        return PLAYLIST
+
+    def add_songs(self, songs: List[Song]):
+        "Adds songs to the playlist and loads missing info"
+        for song in songs:
+            self.playlist.add(song)
+        task = self.add_task(self.resolve_songs(songs))
+        self._streams.add(task)
+        task.add_done_callback(self._streams.discard)
+
+    async def _queue_stream(self, stream: loader.SongStream, count: int):
+        """Queues the rest of the playlist, extracting its next songs
+        only when fewer than PLAYLIST_LOOKAHEAD songs are queued"""
+        message = None
+        last_update = time.monotonic()
+        try:
+            while True:
+                self.playlist.pending[stream] = stream.pending
+                await self._wait_for_room()
+                chunk = await _next_chunk(stream)
+                if chunk is None:
+                    break
+                preload_needed = len(self.playlist) < config.MAX_SONG_PRELOAD
+                self.add_songs(chunk)
+                count += len(chunk)
+                if preload_needed:
+                    self.preload_queue()
+                if time.monotonic() - last_update >= PROGRESS_INTERVAL:
+                    last_update = time.monotonic()
+                    message = await self.send_progress(
+                        message,
+                        config.PLAYLIST_QUEUE_PROGRESS.format(count=count),
+                    )
+        except loader.SongError:
+            print("Failed to queue the rest of playlist:", file=sys.stderr)
+            print_exc(file=sys.stderr)
+        finally:
+            del self.playlist.pending[stream]
+        if message is not None:
+            await self.send_progress(
+                message, config.PLAYLIST_QUEUE_DONE.format(count=count)
+            )
+
+    async def _wait_for_room(self):
+        lookahead = config.PLAYLIST_LOOKAHEAD
+        while lookahead and len(self.playlist) >= lookahead:
+            self._queue_changed.clear()
+            await self._queue_changed.wait()
+
+    def add_task(self, coro: Coroutine) -> asyncio.Task:
         task = self.bot.loop.create_task(coro)
         self._tasks.add(task)
         task.add_done_callback(self._tasks.remove)
+        return task
+
+    async def preload(
+        self,
+        song: Song,
+        margin: float = 0,
+        priority: loader.Priority = loader.Priority.BACKGROUND,
+    ) -> bool:
+        """Same as loader.preload, but gives up when the song is removed
+        from the queue"""
+        task = asyncio.ensure_future(
+            loader.preload(song, margin, priority, self.guild.id)
+        )
+        tasks = self._loading.setdefault(song, set())
+        tasks.add(task)
+        try:
+            await asyncio.wait((task,))
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            tasks.discard(task)
+            if not tasks and self._loading.get(song) is tasks:
+                del self._loading[song]
+        return not task.cancelled() and task.result()
+
+    def cancel_removed(self):
+        """Cancels loading of songs that are no longer queued
+        Their jobs are dropped from the loader queue,
+        results of running ones are discarded"""
+        queued = set(self.playlist.playque)
+        for song, tasks in self._loading.items():
+            if song not in queued:
+                for task in tasks:
+                    task.cancel()
 
     async def _preload_queue(self):
         rerun_needed = False
-        for song in list(
-            islice(self.playlist.playque, 1, config.MAX_SONG_PRELOAD)
-        ):
-            if not await loader.preload(song):
+        songs = islice(self.playlist.playque, 1, config.MAX_SONG_PRELOAD)
+        for i, song in enumerate(list(songs)):
+            # the first one is played next
+            priority = (
+                loader.Priority.NEXT if i == 0 else loader.Priority.BACKGROUND
+            )
+            try:
+                loaded = await self.preload(song, priority=priority)
+            except loader.ThrottledError:
+                # keep the songs, they will be preloaded later
+                break
+            if not loaded:
                 try:
                     self.playlist.playque.remove(song)
                     rerun_needed = True
@@ -402,12 +735,124 @@ class AudioController(object):
     def preload_queue(self):
         "Preloads the first MAX_SONG_PRELOAD songs asynchronously"
         self.add_task(self._preload_queue())
+        # playlists waiting for room may queue more songs now
+        self._queue_changed.set()
+
+    async def resolve_songs(self, songs: Iterable[Song]):
+        """Loads info for songs that don't have it in the background
+        Reports progress to the command channel"""
+
+        songs = [song for song in songs if song.title is None]
+        if not songs:
+            return
+        total = len(songs)
+        done = 0
+        semaphore = asyncio.Semaphore(config.PLAYLIST_RESOLVE_CONCURRENCY)
+
+        async def resolve(song: Song):
+            nonlocal done
+            async with semaphore:
+                try:
+                    # skip songs removed while we were waiting
+                    removed = (
+                        song in self.playlist.playque
+                        and not await self.preload(song)
+                    )
+                except loader.ThrottledError:
+                    # keep it, it will be preloaded before playing
+                    removed = False
+                if removed:
+                    try:
+                        self.playlist.playque.remove(song)
+                    except ValueError:
+                        # already removed
+                        pass
+            done += 1
+
+        # songs are started in queue order
+        tasks = [asyncio.ensure_future(resolve(song)) for song in songs]
+        message = None
+        last_update = time.monotonic()
+        try:
+            for task in asyncio.as_completed(tasks):
+                await task
+                if done == total:
+                    text = config.PLAYLIST_RESOLVE_DONE.format(total=total)
+                    if message is None:
+                        break
+                elif time.monotonic() - last_update < PROGRESS_INTERVAL:
+                    continue
+                else:
+                    text = config.PLAYLIST_RESOLVE_PROGRESS.format(
+                        done=done, total=total
+                    )
+                last_update = time.monotonic()
+                message = await self.send_progress(message, text)
+        finally:
+            # stopped with the player
+            for task in tasks:
+                task.cancel()
+
+    async def send_progress(
+        self, message: Optional[discord.Message], text: str
+    ) -> Optional[discord.Message]:
+        "Sends or edits a progress message in the command channel"
+        # unwrap channel from context
+        channel = self.command_channel
+        channel = getattr(channel, "channel", channel)
+        if channel is None:
+            return None
+        try:
+            if message is None:
+                return await channel.send(text)
+            await message.edit(content=text)
+        except discord.HTTPException:
+            print("Failed to report progress:", file=sys.stderr)
+            print_exc(file=sys.stderr)
+        return message
+
+    def expiring_songs(self, margin: float) -> List[Tuple[float, Song]]:
+        """Returns queued songs with stream URLs expiring within `margin`
+        seconds, along with estimated time until they are played"""
+        result = []
+        songs = iter(self.playlist.playque)
+        current = next(songs, None)
+        if current is None:
+            return result
+        eta = current.duration or AVERAGE_SONG_DURATION
+        if self.playlist.loop == LoopMode.SINGLE:
+            # only the current song will be played
+            songs = (current,)
+        for song in songs:
+            expires = loader.expires_in(song)
+            if expires is not None and expires < margin:
+                result.append((eta, song))
+            eta += song.duration or AVERAGE_SONG_DURATION
+        return result
+
+    def cancel_switch(self):
+        "Cancels loading of the song that was going to fade in"
+        if self._switching:
+            self._switching.cancel()
+            self._switching = None
+
+    def _settle_switch(self):
+        """Called when the song that is going to fade in has started
+        or won't be played, from now on the skipped song may end on its own"""
+        if self._switching is asyncio.current_task():
+            self._switching = None
 
     def stop_player(self):
         """Stops the player and removes all songs from the queue"""
         self.playlist.loop = LoopMode.OFF
         self.playlist.clear()
         self.playlist.next()
+        for task in self._streams:
+            task.cancel()
+        self.cancel_removed()
+        self.cancel_switch()
+        if self._preparing:
+            self._preparing.cancel()
 
         if not self.is_active():
             return
@@ -420,6 +865,7 @@ class AudioController(object):
         prev_song = self.playlist.prev()
         if not prev_song:
             return False
+        self.cancel_switch()
 
         if not self.is_active():
             self.add_task(self.play_song(prev_song))
@@ -461,7 +907,9 @@ class AudioController(object):
         if config.ANNOUNCE_DISCONNECT:
             try:
                 await self.guild.voice_client.play(
-                    discord.FFmpegPCMAudio(asset("disconnect.mp3")),
+                    ffmpegpool.FFmpegPCMAudio(
+                        asset("disconnect.mp3"), options="-loglevel error"
+                    ),
                     wait_finish=True,
                 )
             except Exception:
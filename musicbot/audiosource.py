@@ -0,0 +1,384 @@
+import sys
+import math
+import time
+import threading
+import statistics
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Optional
+
+import discord
+import numpy as np
+from config import config
+
+from musicbot import ffmpegpool
+
+# options that let ffmpeg survive dropped connections
+RECONNECT_OPTIONS = (
+    "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+)
+# seconds of audio in one frame read by the player
+FRAME_LENGTH = discord.opus.Encoder.FRAME_LENGTH / 1000
+# samples of both channels in one frame
+FRAME_SAMPLES = (
+    discord.opus.Encoder.SAMPLES_PER_FRAME * discord.opus.Encoder.CHANNELS
+)
+# seconds over which a volume change is applied
+VOLUME_RAMP = 0.05
+# peaks above this fraction of full scale are softened by the limiter
+LIMITER_THRESHOLD = 0.9
+# how many gaps between songs are remembered
+GAP_SAMPLES = 100
+
+_FULL_SCALE = np.iinfo(np.int16).max
+# position of every sample within its frame, from 0 to 1
+_RAMP = np.repeat(
+    np.arange(discord.opus.Encoder.SAMPLES_PER_FRAME, dtype=np.float32)
+    / discord.opus.Encoder.SAMPLES_PER_FRAME,
+    discord.opus.Encoder.CHANNELS,
+)
+
+
+def _limit(samples: np.ndarray) -> np.ndarray:
+    "Brings samples over full scale back, in place"
+    if not config.SOFT_LIMITER:
+        return np.clip(samples, -_FULL_SCALE, _FULL_SCALE, out=samples)
+    threshold = LIMITER_THRESHOLD * _FULL_SCALE
+    magnitudes = np.abs(samples)
+    if magnitudes.max() <= threshold:
+        return samples
+    over = magnitudes > threshold
+    knee = _FULL_SCALE - threshold
+    samples[over] = np.copysign(
+        threshold + knee * np.tanh((magnitudes[over] - threshold) / knee),
+        samples[over],
+    )
+    return samples
+
+
+def _ramp(start: float, end: float) -> np.ndarray:
+    "Returns gains of the samples of a frame going from start to end"
+    gains = _RAMP * np.float32(end - start)
+    gains += np.float32(start)
+    return gains
+
+
+def _to_frame(samples: np.ndarray) -> np.ndarray:
+    "Cuts or pads samples to the length of one frame"
+    if len(samples) == FRAME_SAMPLES:
+        return samples
+    frame = np.zeros(FRAME_SAMPLES, np.int16)
+    frame[: len(samples)] = samples[:FRAME_SAMPLES]
+    return frame
+
+
+class GainTransformer(discord.AudioSource):
+    """Scales PCM audio of another source by its volume
+    Volume changes are ramped sample by sample over VOLUME_RAMP seconds,
+    so they don't click"""
+
+    def __init__(self, original: discord.AudioSource, volume: float):
+        self.original = original
+        self.volume = volume
+        # gain applied to the last sample read
+        self.gain = volume
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        start, target = self.gain, self.volume
+        if not data or start == target == 1:
+            return data
+        if start == target:
+            samples = np.frombuffer(data, np.int16) * np.float32(target)
+        else:
+            step = FRAME_LENGTH / VOLUME_RAMP
+            end = min(max(target, start - step), start + step)
+            samples = _ramp(start, end)
+            samples *= np.frombuffer(data, np.int16)
+            self.gain = end
+        if max(start, target) > 1:
+            _limit(samples)
+        return samples.astype(np.int16).tobytes()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
+class SongSource(discord.AudioSource):
+    """Audio of a song with adjustable volume
+    At full volume, audio is sent to Discord without being decoded,
+    Opus as it is and other codecs encoded by ffmpeg.
+    Changing volume reopens the song at the same position in the
+    background and switches to it when it catches up
+    A decoder slot must be reserved for it with ffmpegpool"""
+
+    def __init__(
+        self,
+        location: str,
+        codec: Optional[str],
+        volume: float,
+        remote: bool = True,
+    ):
+        self.location = location
+        self.codec = codec
+        self.remote = remote
+        self._volume = volume
+        # frames read by the player so far
+        self.frames = 0
+        self._closed = False
+        # held while reading or replacing the source
+        self._lock = threading.Lock()
+        # only one reopening at a time
+        self._reopen_lock = threading.Lock()
+        self._source = self._open(volume, 0)
+        # the player asks right after reading whether the frame is Opus
+        self._opus = self._source.is_opus()
+        # decodes Opus frames that are mixed with another song
+        self._decoder: Optional[discord.opus.Decoder] = None
+        # song fading out while this one fades in
+        self._fading: Optional[SongSource] = None
+        self._fade_frame = 0
+        self._fade_frames = 0
+
+    def _open(self, volume: float, position: float) -> discord.AudioSource:
+        before_options = RECONNECT_OPTIONS if self.remote else ""
+        if position:
+            before_options += f" -ss {position:.3f}"
+        if self._passthrough(volume):
+            return ffmpegpool.FFmpegOpusAudio(
+                self.location,
+                codec=self.codec,
+                before_options=before_options,
+                options="-loglevel error",
+                stderr=sys.stderr,
+                reserved=True,
+            )
+        return GainTransformer(
+            ffmpegpool.FFmpegPCMAudio(
+                self.location,
+                before_options=before_options,
+                options="-loglevel error",
+                stderr=sys.stderr,
+                reserved=True,
+            ),
+            volume,
+        )
+
+    @staticmethod
+    def _passthrough(volume: float) -> bool:
+        return config.OPUS_PASSTHROUGH and volume >= 1
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = value
+        source = self._source
+        if self._passthrough(value) != source.is_opus():
+            threading.Thread(target=self._reopen, daemon=True).start()
+        elif not source.is_opus():
+            source.volume = value
+
+    def _reopen(self):
+        with self._reopen_lock:
+            opus = self._source.is_opus()
+            if self._closed or self._passthrough(self._volume) == opus:
+                return
+            # both are open until the new one catches up
+            if not ffmpegpool.reserve_blocking(lambda: self._closed):
+                return
+            volume = self._volume
+            if self._passthrough(volume) == opus:
+                # changed back while waiting
+                ffmpegpool.release()
+                return
+            skipped = self.frames
+            source = self._open(volume, skipped * FRAME_LENGTH)
+            while True:
+                with self._lock:
+                    if self._closed:
+                        break
+                    if skipped >= self.frames:
+                        source, self._source = self._source, source
+                        if not self._source.is_opus():
+                            # it may have changed while reopening
+                            self._source.volume = self._volume
+                            if opus:
+                                # ramp down from full volume
+                                self._source.gain = 1.0
+                        break
+                # the song kept playing while the new one started
+                if not source.read():
+                    break
+                skipped += 1
+            source.cleanup()
+
+    @property
+    def position(self) -> float:
+        "Seconds of the song played so far"
+        return self.frames * FRAME_LENGTH
+
+    def fade_from(self, song: "SongSource", length: float):
+        """Mixes the first `length` seconds with the song, fading it out
+        Must be called before this source is played"""
+        self._fading = song
+        self._fade_frame = 0
+        self._fade_frames = max(1, round(length / FRAME_LENGTH))
+
+    def _samples(self, data: bytes, opus: bool) -> np.ndarray:
+        if opus:
+            if self._decoder is None:
+                self._decoder = discord.opus.Decoder()
+            data = self._decoder.decode(data)
+        return _to_frame(np.frombuffer(data, np.int16))
+
+    def _fade(self, data: bytes) -> bytes:
+        "Mixes a frame with the song fading out, returns PCM"
+        # equal power curves, linear within a frame
+        step = math.pi / 2 / self._fade_frames
+        start = self._fade_frame * step
+        end = start + step
+        samples = self._samples(data, self._opus)
+        samples = samples * _ramp(math.sin(start), math.sin(end))
+        song = self._fading
+        other = song.read() if song is not None else b""
+        if other:
+            samples += song._samples(other, song.is_opus()) * _ramp(
+                math.cos(start), math.cos(end)
+            )
+        elif song is not None:
+            # ended before the fade did
+            song.cleanup()
+            self._fading = None
+        self._fade_frame += 1
+        if self._fade_frame >= self._fade_frames:
+            if self._fading is not None:
+                self._fading.cleanup()
+            self._fading = None
+            self._fade_frames = 0
+        self._opus = False
+        return _limit(samples).astype(np.int16).tobytes()
+
+    def read(self) -> bytes:
+        with self._lock:
+            data = self._source.read()
+            self._opus = self._source.is_opus()
+            if data:
+                self.frames += 1
+                if self._fade_frames:
+                    data = self._fade(data)
+        return data
+
+    def is_opus(self) -> bool:
+        return self._opus
+
+    def cleanup(self):
+        with self._lock:
+            self._closed = True
+            self._source.cleanup()
+            if self._fading is not None:
+                self._fading.cleanup()
+                self._fading = None
+
+
+# seconds between the end of a song and the first frame of the next one
+_gaps: Deque[float] = deque(maxlen=GAP_SAMPLES)
+_handovers = 0
+_cuts = 0
+
+
+class Playback(discord.AudioSource):
+    """Songs played by the player one after another
+    The next song can be opened before the current one ends,
+    it is then played from the very next frame"""
+
+    def __init__(self, song: SongSource, ended: Optional[float] = None):
+        global _cuts
+        self.current = song
+        # opened ahead of time, played if handover() returns True
+        self.upcoming: Optional[SongSource] = None
+        self._handover: Optional[Callable[[], bool]] = None
+        # held while reading or changing songs
+        self._lock = threading.Lock()
+        self._opus = song.is_opus()
+        # time.monotonic() when the previous song ended
+        self._ended = ended
+        if ended is not None:
+            _cuts += 1
+
+    @property
+    def volume(self) -> float:
+        return self.current.volume
+
+    @volume.setter
+    def volume(self, value: float):
+        with self._lock:
+            self.current.volume = value
+            if self.upcoming is not None:
+                self.upcoming.volume = value
+
+    def prepare(self, song: SongSource, handover: Callable[[], bool]):
+        """Plays the song when the current one ends, if handover()
+        called from the player thread at that moment allows it"""
+        with self._lock:
+            if self.upcoming is not None:
+                self.upcoming.cleanup()
+            self.upcoming = song
+            self._handover = handover
+
+    def switch(self, song: SongSource, fade: float):
+        "Fades from the current song to another one"
+        with self._lock:
+            song.fade_from(self.current, fade)
+            self.current = song
+            if self.upcoming is not None:
+                # it was going to follow the previous song
+                self.upcoming.cleanup()
+                self.upcoming = None
+
+    def read(self) -> bytes:
+        global _handovers
+        with self._lock:
+            data = self.current.read()
+            if not data and self.upcoming is not None:
+                upcoming, self.upcoming = self.upcoming, None
+                if self._handover():
+                    self._ended = time.monotonic()
+                    self.current.cleanup()
+                    self.current = upcoming
+                    data = upcoming.read()
+                    _handovers += 1
+                else:
+                    upcoming.cleanup()
+            self._opus = self.current.is_opus()
+        if data and self._ended is not None:
+            _gaps.append(time.monotonic() - self._ended)
+            self._ended = None
+        return data
+
+    def is_opus(self) -> bool:
+        return self._opus
+
+    def cleanup(self):
+        with self._lock:
+            self.current.cleanup()
+            if self.upcoming is not None:
+                self.upcoming.cleanup()
+                self.upcoming = None
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "gapless": f"{_handovers} of {_handovers + _cuts} songs",
+        **(
+            {
+                "gap between songs": (
+                    f"{statistics.mean(_gaps) * 1000:.1f} ms on average,"
+                    f" {max(_gaps) * 1000:.1f} ms at most"
+                )
+            }
+            if _gaps
+            else {}
+        ),
+    }
@@ -1,5 +1,6 @@
 import re
 import sys
+import time
 import asyncio
 from traceback import print_exception
 from typing import Dict, Union, List
@@ -12,6 +13,7 @@ from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from config import config
+from musicbot import loader, linkutils
 from musicbot.audiocontroller import VC_CONNECT_TIMEOUT, AudioController
 from musicbot.settings import (
     GuildSettings,
@@ -20,6 +22,9 @@ from musicbot.settings import (
 )
 from musicbot.utils import CheckError
 
+# seconds after which an interaction can't be replied to
+INTERACTION_LIFETIME = 15 * 60
+
 
 class MusicBot(bridge.Bot):
     def __init__(self, *args, **kwargs):
@@ -49,6 +54,8 @@ class MusicBot(bridge.Bot):
         async with self.db_engine.connect() as connection:
             await connection.run_sync(run_migrations)
         await extract_legacy_settings(self)
+        # for Spotify and other sites loaded without workers
+        await linkutils.init()
         return await super().start(*args, **kwargs)
 
     async def close(self):
@@ -61,6 +68,7 @@ class MusicBot(bridge.Bot):
                 for audiocontroller in self.audio_controllers.values()
             )
         )
+        await linkutils.stop()
         return await super().close()
 
     async def on_ready(self):
@@ -75,6 +83,9 @@ class MusicBot(bridge.Bot):
         if not self.update_views.is_running():
             self.update_views.start()
 
+        if not self.refresh_streams.is_running():
+            self.refresh_streams.start()
+
         if not self.absolutely_ready.done():
             self.absolutely_ready.set_result(True)
 
@@ -124,6 +135,31 @@ class MusicBot(bridge.Bot):
             )
         )
 
+    @tasks.loop(seconds=30)
+    async def refresh_streams(self):
+        """Reloads stream URLs of queued songs shortly before they expire
+        Songs that will be played sooner are refreshed first"""
+        songs = []
+        for audiocontroller in self.audio_controllers.values():
+            songs.extend(
+                (eta, song, audiocontroller)
+                for eta, song in audiocontroller.expiring_songs(
+                    config.STREAM_REFRESH_MARGIN
+                )
+            )
+        songs.sort(key=lambda item: item[0])
+        for _, song, audiocontroller in songs[: config.STREAM_REFRESH_LIMIT]:
+            if loader.is_busy():
+                # don't slow down user requests, try again later
+                break
+            try:
+                await audiocontroller.preload(
+                    song, config.STREAM_REFRESH_MARGIN
+                )
+            except loader.ThrottledError:
+                # try again on the next run
+                break
+
     def add_application_command(self, command):
         if not config.ENABLE_SLASH_COMMANDS:
             return
@@ -232,6 +268,18 @@ class Context(bridge.BridgeContext):
     bot: MusicBot
     guild: discord.Guild
 
+    @property
+    def deadline(self) -> float:
+        "time.monotonic() after which loading songs for the user is useless"
+        timeout = config.REQUEST_DEADLINE
+        interaction = getattr(self, "interaction", None)
+        if interaction:
+            age = discord.utils.utcnow() - interaction.created_at
+            timeout = min(
+                timeout, INTERACTION_LIFETIME - age.total_seconds()
+            )
+        return time.monotonic() + timeout
+
     async def send(self, *args, **kwargs):
         kwargs.pop("reference", None)  # not supported
         audiocontroller = self.bot.audio_controllers[self.guild]
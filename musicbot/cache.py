@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import sqlite3
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from config import config
+
+
+class LRUCache:
+    """Bounded in-memory mapping with expiring items"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Tuple[Any, float]]:
+        "Returns value with its expiration time"
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            return None
+        if expires <= time.time():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value, expires
+
+    def put(self, key: str, value: Any, expires: float):
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while self._data and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: str):
+        self._data.pop(key, None)
+
+
+class PersistentCache:
+    """Two-tier cache: LRU in memory backed by SQLite table on disk
+    Values must be JSON-serializable"""
+
+    # how many times more items are kept on disk than in memory
+    DISK_RATIO = 10
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self.memory = LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._puts = 0
+
+    @property
+    def db(self) -> Optional[sqlite3.Connection]:
+        # open lazily to avoid touching the file from worker processes
+        if self._db is None and config.CACHE_DIR:
+            os.makedirs(config.CACHE_DIR, exist_ok=True)
+            self._db = sqlite3.connect(
+                os.path.join(config.CACHE_DIR, "cache.db")
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=OFF")
+            self._db.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.name} ("
+                "key TEXT PRIMARY KEY, value TEXT,"
+                " expires REAL, accessed REAL)"
+            )
+            self._db.execute(
+                f"DELETE FROM {self.name} WHERE expires <= ?", (time.time(),)
+            )
+            self._db.commit()
+        return self._db
+
+    def get(self, key: str) -> Any:
+        item = self.memory.get(key)
+        if item is None and self.db:
+            now = time.time()
+            row = self.db.execute(
+                f"SELECT value, expires FROM {self.name}"
+                " WHERE key = ? AND expires > ?",
+                (key, now),
+            ).fetchone()
+            if row:
+                item = (json.loads(row[0]), row[1])
+                self.memory.put(key, *item)
+                self.db.execute(
+                    f"UPDATE {self.name} SET accessed = ? WHERE key = ?",
+                    (now, key),
+                )
+                self.db.commit()
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item[0]
+
+    def put(self, key: str, value: Any, ttl: float):
+        now = time.time()
+        self.memory.put(key, value, now + ttl)
+        if not self.db:
+            return
+        self.db.execute(
+            f"INSERT OR REPLACE INTO {self.name} VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), now + ttl, now),
+        )
+        self._puts += 1
+        # size 0 turns the memory tier off, disk is then trimmed every time
+        if self._puts % max(self.memory.maxsize, 1) == 0:
+            self._trim()
+        self.db.commit()
+
+    def pop(self, key: str):
+        self.memory.pop(key)
+        if self.db:
+            self.db.execute(f"DELETE FROM {self.name} WHERE key = ?", (key,))
+            self.db.commit()
+
+    def _trim(self):
+        now = time.time()
+        self.db.execute(f"DELETE FROM {self.name} WHERE expires <= ?", (now,))
+        if self.memory.maxsize <= 0:
+            # only bounded by the time to live
+            return
+        self.db.execute(
+            f"DELETE FROM {self.name} WHERE key IN ("
+            f"SELECT key FROM {self.name} ORDER BY accessed DESC"
+            " LIMIT -1 OFFSET ?)",
+            (self.memory.maxsize * self.DISK_RATIO,),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "in memory": len(self.memory),
+        }
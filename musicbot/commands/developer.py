@@ -11,6 +11,7 @@ from discord.ext import commands
 from discord.ext.pages import Paginator
 from aioconsole import aexec
 
+from musicbot import audiocache, audiosource, ffmpegpool, loader
 from musicbot.bot import Context, MusicBot
 
 
@@ -41,6 +42,15 @@ OUTPUT_FORMAT = "```\n\u200b{}\n```"
 _paginate = Splitter(2002 - len(OUTPUT_FORMAT)).wrap
 
 
+async def send_output(ctx: Context, output: str):
+    pages = (page.rstrip() for page in _paginate(output))
+    pages = [OUTPUT_FORMAT.format(page) for page in pages if page]
+    if len(pages) == 1:
+        await ctx.send(pages[0])
+    else:
+        await Paginator(pages).send(ctx)
+
+
 class Developer(commands.Cog):
     def __init__(self, bot: MusicBot):
         self.bot = bot
@@ -84,12 +94,7 @@ class Developer(commands.Cog):
         output = output.getvalue()
 
         if output and not output.isspace():
-            pages = (page.rstrip() for page in _paginate(output))
-            pages = [OUTPUT_FORMAT.format(page) for page in pages if page]
-            if len(pages) == 1:
-                await ctx.send(pages[0])
-            else:
-                await Paginator(pages).send(ctx)
+            await send_output(ctx, output)
         else:
             try:
                 suppress = ctx.channel.last_message.author == ctx.me
@@ -98,6 +103,24 @@ class Developer(commands.Cog):
             if not suppress:
                 await ctx.send("No output.")
 
+    @commands.command(
+        name="stats",
+        hidden=True,
+    )
+    @commands.is_owner()
+    async def _stats(self, ctx: Context):
+        output = []
+        stats = {
+            **loader.stats(),
+            "audio cache": audiocache.stats(),
+            "playback": audiosource.stats(),
+            "ffmpeg": ffmpegpool.stats(),
+        }
+        for component, values in stats.items():
+            output.append(component + ":")
+            output.extend(f"  {k}: {v}" for k, v in values.items())
+        await send_output(ctx, "\n".join(output))
+
 
 def setup(bot: MusicBot):
     bot.add_cog(Developer(bot))
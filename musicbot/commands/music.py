@@ -1,3 +1,4 @@
+import asyncio
 from typing import Iterable, Union
 
 from discord import Attachment
@@ -86,8 +87,15 @@ class Music(commands.Cog):
         # reset timer
         await ctx.audiocontroller.timer.start(True)
 
+        task = asyncio.ensure_future(
+            ctx.audiocontroller.process_song(track, ctx.deadline)
+        )
+        await asyncio.wait((task,), timeout=config.LOAD_REPLY_TIMEOUT)
+        if not task.done():
+            # don't keep the user waiting without a reply
+            await ctx.send(config.SONGINFO_STILL_LOADING)
         try:
-            song = await ctx.audiocontroller.process_song(track)
+            song = await task
         except SongError as e:
             await ctx.send(e)
             return
@@ -116,7 +124,16 @@ class Music(commands.Cog):
     )
     async def _search(self, ctx: AudioContext, *, query: str):
         await ctx.defer()
-        results = await search_youtube(query, config.SEARCH_RESULTS)
+        try:
+            results = await search_youtube(
+                query,
+                config.SEARCH_RESULTS,
+                guild=ctx.guild.id,
+                deadline=ctx.deadline,
+            )
+        except SongError as e:
+            await ctx.send(e)
+            return
         songs = []
         for data in results:
             song = Song(
@@ -236,6 +253,7 @@ class Music(commands.Cog):
             queue_number = len(ctx.audiocontroller.playlist)
         try:
             song = ctx.audiocontroller.playlist.remove(queue_number - 1)
+            ctx.audiocontroller.cancel_removed()
             ctx.audiocontroller.preload_queue()
             title = song.title or song.webpage_url
             await ctx.send(f"Removed #{queue_number}: {title}")
@@ -261,6 +279,7 @@ class Music(commands.Cog):
     )
     async def _clear(self, ctx: AudioContext):
         ctx.audiocontroller.playlist.clear()
+        ctx.audiocontroller.cancel_removed()
         await ctx.send("Cleared queue :no_entry_sign:")
 
     @bridge.bridge_command(
@@ -0,0 +1,377 @@
+"""ffmpeg processes started before they are needed
+
+Starting ffmpeg means forking the bot and loading all of ffmpeg's
+libraries, which adds up when many songs start at once. Processes
+for each set of output options are started in advance, reading
+a concat demuxer script from stdin. When a song starts, one of them
+gets the script naming its input and begins to play it at once.
+
+The number of running ffmpeg processes is capped by MAX_DECODERS.
+A slot is reserved before a song is opened, songs wait for their turn,
+optional work is skipped.
+"""
+
+import os
+import re
+import sys
+import time
+import atexit
+import asyncio
+import threading
+import statistics
+import subprocess
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+import discord
+from config import config
+
+# how many spawn times are remembered
+LATENCY_SAMPLES = 100
+# protocols that inputs can be read with
+PROTOCOLS = "pipe,file,http,https,tcp,tls,crypto"
+# first version of ffmpeg with the concat "option" directive
+MIN_VERSION = (5, 1)
+
+_version_regex = re.compile(r"ffmpeg version n?(\d+)\.(\d+)")
+
+# idle processes by executable and output options
+_idle: Dict[Tuple[str, ...], List[subprocess.Popen]] = {}
+# output options that idle processes are being started for
+_filling: Set[Tuple[str, ...]] = set()
+_lock = threading.Lock()
+# notified when a slot is freed
+_slot_freed = threading.Condition(_lock)
+# None until ffmpeg version is checked
+_supported: Optional[bool] = None
+_running = 0
+_freed: Optional[asyncio.Event] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+# seconds spent in Popen, wherever it was called
+_spawn_times: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+# seconds until a process got its input, as seen by the song
+_start_times: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
+_warm_starts = 0
+_cold_starts = 0
+# processes started again because the one started in advance failed
+_restarts = 0
+
+
+def available() -> bool:
+    "Returns whether another process can be started within the limit"
+    return not config.MAX_DECODERS or _running < config.MAX_DECODERS
+
+
+def reserve() -> bool:
+    "Takes a slot for a process if one is free"
+    global _running
+    with _lock:
+        if not available():
+            return False
+        _running += 1
+        return True
+
+
+async def wait_reserve():
+    "Waits for a free slot and takes it"
+    global _freed, _loop
+    if _freed is None:
+        _freed = asyncio.Event()
+        _loop = asyncio.get_running_loop()
+    while not reserve():
+        _freed.clear()
+        await _freed.wait()
+
+
+def reserve_blocking(cancelled: Callable[[], bool]) -> bool:
+    """Waits for a free slot in a thread and takes it
+    Returns False if cancelled() returns True first"""
+    global _running
+    with _slot_freed:
+        while not available():
+            if cancelled():
+                return False
+            # cancelling doesn't notify
+            _slot_freed.wait(1)
+        _running += 1
+        return True
+
+
+def acquire():
+    "Takes a slot even if there's no free one"
+    global _running
+    with _lock:
+        _running += 1
+
+
+def release():
+    "Frees a slot, can be called from any thread"
+    global _running
+    with _slot_freed:
+        _running -= 1
+        _slot_freed.notify_all()
+    if _loop is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_freed.set)
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def _script(source: str, before: List[str]) -> Optional[str]:
+    """Returns concat demuxer script opening the source with options,
+    None if they can't be expressed there"""
+    if "://" not in source:
+        # paths are relative to the script, which is pipe:
+        source = "file:" + os.path.abspath(source)
+    lines = ["ffconcat version 1.0", "file " + _quote(source)]
+    if len(before) % 2:
+        return None
+    for name, value in zip(before[::2], before[1::2]):
+        if not name.startswith("-"):
+            return None
+        if name == "-ss":
+            lines.append("inpoint " + value)
+        else:
+            lines.append(f"option {name[1:]} {_quote(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _check_version(executable: str) -> bool:
+    try:
+        output = subprocess.run(
+            [executable, "-version"],
+            capture_output=True,
+            text=True,
+            creationflags=discord.player.CREATE_NO_WINDOW,
+        ).stdout
+    except OSError:
+        return False
+    match = _version_regex.match(output)
+    # builds from git are named by date or commit
+    return match is None or tuple(map(int, match.groups())) >= MIN_VERSION
+
+
+def _start(args: List[str], **kwargs) -> subprocess.Popen:
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        args, creationflags=discord.player.CREATE_NO_WINDOW, **kwargs
+    )
+    _spawn_times.append(time.perf_counter() - started)
+    return process
+
+
+def _fill(key: Tuple[str, ...], stderr: Any):
+    "Starts idle processes for the output options"
+    global _supported
+    executable, *output = key
+    if _supported is None:
+        _supported = _check_version(executable)
+    while _supported:
+        with _lock:
+            if len(_idle.setdefault(key, [])) >= config.FFMPEG_POOL_SIZE:
+                break
+        try:
+            process = _start(
+                [
+                    executable,
+                    "-f",
+                    "concat",
+                    "-safe",
+                    "0",
+                    "-protocol_whitelist",
+                    PROTOCOLS,
+                    "-i",
+                    "pipe:0",
+                    *output,
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+            )
+        except (OSError, subprocess.SubprocessError) as e:
+            print("Failed to start ffmpeg in advance:", e, file=sys.stderr)
+            break
+        with _lock:
+            _idle[key].append(process)
+    with _lock:
+        _filling.discard(key)
+
+
+def _take(key: Tuple[str, ...]) -> Optional[subprocess.Popen]:
+    with _lock:
+        idle = _idle.get(key, [])
+        while idle:
+            process = idle.pop()
+            if process.poll() is None:
+                return process
+    return None
+
+
+@atexit.register
+def _close():
+    "Kills idle processes, so they don't complain about missing input"
+    with _lock:
+        for processes in _idle.values():
+            for process in processes:
+                process.kill()
+            processes.clear()
+
+
+def _reject():
+    "Stops starting processes in advance, this ffmpeg can't use them"
+    global _supported
+    _supported = False
+    print(
+        "ffmpeg rejected the input of a process started in advance,"
+        " starting processes when they are needed from now on",
+        file=sys.stderr,
+    )
+    _close()
+
+
+def spawn(args: List[str], **kwargs) -> Tuple[subprocess.Popen, bool]:
+    """Starts ffmpeg with the arguments, using a process started
+    in advance if there is one, and starts another in its place
+    Returns the process and whether it was started in advance"""
+    global _warm_starts, _cold_starts
+    started = time.perf_counter()
+    executable = args[0]
+    try:
+        split = args.index("-i")
+    except ValueError:
+        split = None
+    script = None
+    warm = False
+    if (
+        config.FFMPEG_POOL_SIZE
+        and split is not None
+        and kwargs.get("stdin") != subprocess.PIPE
+    ):
+        script = _script(args[split + 1], args[1:split])
+    if script is None:
+        process = _start(args, **kwargs)
+        _cold_starts += 1
+    else:
+        key = (executable, *args[split + 2 :])
+        process = _take(key)
+        if process is None:
+            process = _start(args, **kwargs)
+            _cold_starts += 1
+        else:
+            try:
+                process.stdin.write(script.encode())
+                process.stdin.close()
+                # or communicate() would flush it when killing the process
+                process.stdin = None
+            except OSError:
+                # it has died since it was checked
+                process.kill()
+                process = _start(args, **kwargs)
+                _cold_starts += 1
+            else:
+                _warm_starts += 1
+                warm = True
+        with _lock:
+            fill = _supported is not False and key not in _filling
+            _filling.add(key)
+        if fill:
+            threading.Thread(
+                target=_fill, args=(key, kwargs.get("stderr")), daemon=True
+            ).start()
+    _start_times.append(time.perf_counter() - started)
+    return process, warm
+
+
+class _Pooled(discord.player.FFmpegAudio):
+    """Takes its process from the pool and holds a slot while it runs
+    With `reserved`, the slot was taken beforehand, otherwise it's taken
+    regardless of the limit"""
+
+    def __init__(self, *args, reserved: bool = False, **kwargs):
+        if not reserved:
+            acquire()
+        self._slot = True
+        # cleaned up by __del__ even if spawning fails
+        self._process = discord.utils.MISSING
+        # arguments to start the process again with, if it was started
+        # in advance and no audio was read from it yet
+        self._cold_start: Optional[Tuple[List[str], Dict[str, Any]]] = None
+        try:
+            super().__init__(*args, **kwargs)
+        except BaseException:
+            self.cleanup()
+            raise
+
+    def _spawn_process(self, args, **subprocess_kwargs) -> subprocess.Popen:
+        try:
+            process, warm = spawn(args, **subprocess_kwargs)
+        except FileNotFoundError:
+            raise discord.ClientException(f"{args[0]} was not found.")
+        except subprocess.SubprocessError as e:
+            raise discord.ClientException(
+                f"Popen failed: {e.__class__.__name__}: {e}"
+            ) from e
+        if warm:
+            self._cold_start = (args, subprocess_kwargs)
+        return process
+
+    def read(self) -> bytes:
+        global _restarts
+        data = super().read()
+        cold_start, self._cold_start = self._cold_start, None
+        if data or cold_start is None or self._process.wait() == 0:
+            return data
+        # ffmpeg may not understand the script, try without it
+        _restarts += 1
+        self._process.stdout.close()
+        self._process = _start(cold_start[0], **cold_start[1])
+        self._stdout = self._process.stdout
+        self._restarted()
+        data = super().read()
+        if data and _supported:
+            _reject()
+        return data
+
+    def _restarted(self):
+        "Called when the process was started again"
+
+    def cleanup(self):
+        super().cleanup()
+        with _lock:
+            slot, self._slot = self._slot, False
+        if slot:
+            release()
+
+
+class FFmpegPCMAudio(_Pooled, discord.FFmpegPCMAudio):
+    pass
+
+
+class FFmpegOpusAudio(_Pooled, discord.FFmpegOpusAudio):
+    def _restarted(self):
+        self._packet_iter = discord.oggparse.OggStream(
+            self._stdout
+        ).iter_packets()
+
+
+def _describe(samples: Deque[float]) -> str:
+    return (
+        f"{statistics.mean(samples) * 1000:.1f} ms on average,"
+        f" {max(samples) * 1000:.1f} ms at most"
+    )
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        idle = sum(map(len, _idle.values()))
+    return {
+        "running": _running,
+        "idle": idle,
+        "started in advance": (
+            f"{_warm_starts} of {_warm_starts + _cold_starts}"
+        ),
+        "started again": _restarts,
+        **({"spawn time": _describe(_spawn_times)} if _spawn_times else {}),
+        **({"start time": _describe(_start_times)} if _start_times else {}),
+    }
@@ -0,0 +1,6 @@
+"""Preloaded by the server that extraction worker processes are
+forked from, so they start with yt-dlp and the extractor index ready"""
+
+from musicbot.linkutils import get_ie_index
+
+get_ie_index()
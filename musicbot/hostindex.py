@@ -0,0 +1,377 @@
+"""Index of URL patterns by the domains they can match
+
+Each pattern is walked from its start with sre_parse up to the end
+of the host, listing every domain it accepts. URLs are then split
+into pieces on characters that can't be a part of a domain, so any
+URL matched by a pattern contains at least one of its domains.
+A domain preceded by a wildcard is indexed by the part after its
+first dot, and a wildcard top-level domain is stored as "*".
+Patterns like "scheme:id" are indexed by their scheme.
+"""
+
+import re
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+)
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+# limit on the number of alternatives considered per pattern
+MAX_EXPANSIONS = 4096
+# character classes with up to this many letters are expanded
+MAX_CLASS_SIZE = 4
+
+_piece_regex = re.compile(r"[\w.-]+")
+_scheme_regex = re.compile(r"[\w.+-]+:")
+
+_CHAR_NODES = (
+    sre_parse.LITERAL,
+    sre_parse.NOT_LITERAL,
+    sre_parse.IN,
+    sre_parse.ANY,
+)
+
+
+class _Unindexable(Exception):
+    pass
+
+
+def _is_host_char(char: str) -> bool:
+    return _piece_regex.fullmatch(char) is not None
+
+
+class _State:
+    "One alternative of a pattern being walked from the start"
+
+    __slots__ = ("scheme", "scheme_wild", "host", "wild", "tld", "groups")
+
+    def __init__(self):
+        self.scheme = ""
+        # whether the scheme has unknown characters
+        self.scheme_wild = False
+        # None while still before the "//"
+        self.host: Optional[str] = None
+        # whether the host may start with unknown characters
+        self.wild = False
+        # whether the host ends with an unknown top-level domain
+        self.tld = False
+        # capturing groups matched so far
+        self.groups = frozenset()
+
+    def copy(self) -> "_State":
+        state = _State()
+        for name in self.__slots__:
+            setattr(state, name, getattr(self, name))
+        return state
+
+
+def _class_chars(items) -> Optional[Set[str]]:
+    "Returns characters of a class made only of literals"
+    chars = set()
+    for op, arg in items:
+        if op is not sre_parse.LITERAL:
+            return None
+        chars.add(chr(arg).lower())
+    return chars
+
+
+def _class_matches(items, char: str) -> bool:
+    "Whether a character class can match the character"
+    negate = False
+    found = False
+    for op, arg in items:
+        if op is sre_parse.NEGATE:
+            negate = True
+        elif op is sre_parse.LITERAL:
+            found |= chr(arg) == char
+        elif op is sre_parse.RANGE:
+            found |= arg[0] <= ord(char) <= arg[1]
+        elif op is sre_parse.CATEGORY:
+            name = str(arg)
+            if "DIGIT" in name:
+                hit = char.isdigit()
+            elif "WORD" in name:
+                hit = char.isalnum() or char == "_"
+            elif "SPACE" in name:
+                hit = char.isspace()
+            else:
+                hit = True
+            found |= hit != ("_NOT_" in name)
+        else:
+            found = True
+    return found != negate
+
+
+def _matches(op, arg, char: str) -> bool:
+    "Whether a single character node can match the character"
+    if op is sre_parse.LITERAL:
+        return chr(arg) == char
+    if op is sre_parse.NOT_LITERAL:
+        return chr(arg) != char
+    if op is sre_parse.IN:
+        return _class_matches(arg, char)
+    # ANY or a whole subpattern
+    return True
+
+
+def _is_label_class(op, arg) -> bool:
+    "Whether the node only matches letters, digits and dashes"
+    if op is not sre_parse.IN:
+        return False
+    for item, value in arg:
+        if item is sre_parse.LITERAL:
+            chars = [chr(value)]
+        elif item is sre_parse.RANGE and value[1] - value[0] < 128:
+            chars = map(chr, range(value[0], value[1] + 1))
+        elif item is sre_parse.CATEGORY:
+            if str(value) not in ("CATEGORY_DIGIT", "CATEGORY_WORD"):
+                return False
+            continue
+        else:
+            return False
+        if any(c == "." or not _is_host_char(c) for c in chars):
+            return False
+    return True
+
+
+class _Walker:
+    "Collects domains accepted by patterns"
+
+    def __init__(self):
+        self.keys: Set[str] = set()
+
+    def walk(self, pattern: str):
+        parsed = sre_parse.parse(pattern)
+        if self.sequence(list(parsed), [_State()]):
+            # pattern ended before the host did
+            raise _Unindexable
+
+    def sequence(self, items, states: List[_State]) -> List[_State]:
+        for op, arg in items:
+            if not states:
+                break
+            states = self.node(op, arg, states)
+            if len(states) > MAX_EXPANSIONS:
+                raise _Unindexable
+        return states
+
+    def node(self, op, arg, states: List[_State]) -> List[_State]:
+        if op is sre_parse.SUBPATTERN:
+            states = self.sequence(list(arg[-1]), states)
+            if arg[0]:
+                for state in states:
+                    state.groups |= {arg[0]}
+            return states
+        if op is sre_parse.BRANCH:
+            return self.branch(arg[1], states)
+        if op is sre_parse.GROUPREF_EXISTS:
+            group, yes, no = arg
+            matched = [s for s in states if group in s.groups]
+            others = [s for s in states if group not in s.groups]
+            if no is not None:
+                others = self.sequence(list(no), others)
+            return self.sequence(list(yes), matched) + others
+        if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            # lookarounds only narrow the match
+            return states
+        if op is sre_parse.AT:
+            if arg in (sre_parse.AT_END, sre_parse.AT_END_STRING):
+                for state in states:
+                    self.end(state)
+                return []
+            return states
+        if op is sre_parse.LITERAL:
+            return self.char(chr(arg), states)
+        if op is sre_parse.IN:
+            chars = _class_chars(arg)
+            if chars is not None and len(chars) <= MAX_CLASS_SIZE:
+                return self.branch(sorted(chars), states)
+            return self.wildcard(op, arg, states)
+        if op in (sre_parse.NOT_LITERAL, sre_parse.ANY):
+            return self.wildcard(op, arg, states)
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            low, high, item = arg
+            item = list(item)
+            if low == 0:
+                # may match nothing at all
+                skipped = [s.copy() for s in states]
+                return skipped + self.node(op, (1, high, item), states)
+            if high == low:
+                for _ in range(low):
+                    states = self.sequence(item, states)
+                return states
+            if len(item) == 1 and item[0][0] in _CHAR_NODES:
+                return self.repeat(*item[0], states)
+            return self.wildcard(None, None, states)
+        raise _Unindexable
+
+    def branch(self, branches: Iterable, states: List[_State]):
+        result = []
+        for branch in branches:
+            copies = [s.copy() for s in states]
+            if isinstance(branch, str):
+                result += self.char(branch, copies)
+            else:
+                result += self.sequence(list(branch), copies)
+        return result
+
+    def char(self, char: str, states: List[_State]) -> List[_State]:
+        result = []
+        for state in states:
+            if state.host is None:
+                if self.scheme_char(state, char):
+                    result.append(state)
+            elif not _is_host_char(char):
+                self.end(state)
+            elif state.tld:
+                # the wildcard was not the top-level domain after all
+                state.host = char.lower()
+                state.wild = True
+                state.tld = False
+                result.append(state)
+            else:
+                state.host += char.lower()
+                result.append(state)
+        return result
+
+    def scheme_char(self, state: _State, char: str) -> bool:
+        "Returns whether the state is still walking"
+        if ":" not in state.scheme:
+            if char == ":":
+                if not (state.scheme or state.scheme_wild):
+                    # can't be a URL
+                    return False
+            elif not _scheme_regex.match(char + ":"):
+                return False
+        elif char != "/":
+            self.end(state)
+            return False
+        elif state.scheme.endswith("/"):
+            state.host = ""
+            return True
+        state.scheme += char
+        return True
+
+    def repeat(self, op, arg, states: List[_State]) -> List[_State]:
+        "Handles more than one repetition of a single character"
+        if any(state.host is None for state in states):
+            return self.wildcard(op, arg, states)
+        if op is sre_parse.LITERAL and not _is_host_char(chr(arg)):
+            # the host ends on the first one
+            return self.char(chr(arg), states)
+        if op is sre_parse.IN:
+            chars = _class_chars(arg)
+            if chars and not any(map(_is_host_char, chars)):
+                return self.char(min(chars), states)
+        return self.wildcard(op, arg, states)
+
+    def wildcard(self, op, arg, states: List[_State]) -> List[_State]:
+        "Handles a run of unknown characters"
+        result = []
+        for state in states:
+            if state.host is None:
+                if ":" in state.scheme:
+                    self.end(state)
+                    continue
+                if _matches(op, arg, ":"):
+                    raise _Unindexable
+                state.scheme_wild = True
+            elif (
+                state.host.endswith(".")
+                and not state.tld
+                and _is_label_class(op, arg)
+            ):
+                state.host += "*"
+                state.tld = True
+            else:
+                state.host = ""
+                state.wild = True
+                state.tld = False
+            result.append(state)
+        return result
+
+    def end(self, state: _State):
+        "Adds the key of a state that has reached the end of its host"
+        if state.host is None:
+            if ":" not in state.scheme:
+                # can't be a URL
+                return
+            if state.scheme_wild:
+                raise _Unindexable
+            key = state.scheme.partition(":")[0].lower()
+            if not _piece_regex.fullmatch(key):
+                raise _Unindexable
+        else:
+            key = state.host
+            if state.wild:
+                # only the part after the first dot is a whole domain
+                key = key.partition(".")[2]
+        if not key.strip(".*"):
+            raise _Unindexable
+        self.keys.add(key)
+
+
+def pattern_keys(patterns: Iterable[str]) -> Optional[Set[str]]:
+    "Returns domains accepted by the patterns, None if they can't be listed"
+    walker = _Walker()
+    try:
+        for pattern in patterns:
+            walker.walk(pattern)
+    except (_Unindexable, re.error, RecursionError):
+        return None
+    return walker.keys
+
+
+def url_keys(url: str) -> Set[str]:
+    "Returns domains under which patterns matching the URL may be indexed"
+    keys = set()
+    for piece in _piece_regex.findall(url.lower()):
+        while piece:
+            keys.add(piece)
+            domain, dot, _ = piece.rpartition(".")
+            if dot:
+                keys.add(domain + ".*")
+            piece = piece.partition(".")[2]
+    return keys
+
+
+class HostIndex:
+    """Maps domains to the items whose URL patterns can accept them.
+    Items with patterns that can't be analyzed are always candidates"""
+
+    def __init__(
+        self,
+        items: Sequence,
+        get_patterns: Callable[..., Optional[Iterable[str]]],
+    ):
+        self.items = items
+        self.domains: Dict[str, List[int]] = {}
+        self.fallback: List[int] = []
+        for i, item in enumerate(items):
+            patterns = get_patterns(item)
+            keys = None if patterns is None else pattern_keys(patterns)
+            if keys is None:
+                self.fallback.append(i)
+                continue
+            for key in keys:
+                self.domains.setdefault(key, []).append(i)
+
+    def candidates(self, url: str) -> Iterator:
+        "Returns items that may accept the URL, in their original order"
+        if not _scheme_regex.match(url):
+            # only strings starting with a scheme are indexed
+            return iter(self.items)
+        found = set(self.fallback)
+        for key in url_keys(url):
+            found.update(self.domains.get(key, ()))
+        return map(self.items.__getitem__, sorted(found))
@@ -1,13 +1,16 @@
 import re
 import sys
 import asyncio
+import threading
 from enum import Enum, auto
+from functools import lru_cache
 from traceback import print_exc
 from urllib.request import urlparse
+from urllib.parse import urlencode, parse_qsl
 from multiprocessing import current_process
-from typing import Optional, Union, List
+from typing import Dict, Optional, Union, List
 
-from spotipy import Spotify
+from spotipy import Spotify, SpotifyException
 from bs4 import BeautifulSoup
 from aiohttp import ClientSession
 from spotipy.oauth2 import SpotifyClientCredentials
@@ -17,6 +20,7 @@ from yt_dlp.extractor.lazy_extractors import LazyLoadExtractor
 
 from config import config
 from musicbot import loader
+from musicbot.hostindex import HostIndex
 
 
 spotify_api = None
@@ -44,6 +48,8 @@ if config.SPOTIFY_ID or config.SPOTIFY_SECRET:
 ExtractorT = Union[InfoExtractor, LazyLoadExtractor]
 EXTRACTORS = gen_extractor_classes()
 YT_IE = next(ie for ie in EXTRACTORS if ie.IE_NAME == "youtube")
+# number of URLs to remember the extractor for
+IE_CACHE_SIZE = 1024
 # Modified version of
 # https://gist.github.com/gruber/249502#gistcomment-1328838
 url_regex = re.compile(
@@ -69,16 +75,22 @@ headers = {
     )
 }
 
-_session = None
+# HTTP sessions by event loops they belong to
+_sessions: Dict[asyncio.AbstractEventLoop, ClientSession] = {}
+_ie_index = None
+_ie_index_lock = threading.Lock()
 
 
 async def init():
-    global _session
-    _session = ClientSession(headers=headers)
+    "Opens HTTP session for the running event loop"
+    _sessions[asyncio.get_running_loop()] = ClientSession(headers=headers)
 
 
 async def stop():
-    await _session.close()
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is None:
+        return
+    await session.close()
     # according to aiohttp docs, we need to wait a little after closing session
     await asyncio.sleep(0.5)
 
@@ -101,8 +113,12 @@ class Origins(Enum):
     Playlist = "Playlist"
 
 
+def get_session() -> ClientSession:
+    return _sessions[asyncio.get_running_loop()]
+
+
 async def get_soup(url: str) -> BeautifulSoup:
-    async with _session.get(url) as response:
+    async with get_session().get(url) as response:
         response.raise_for_status()
         page = await response.text()
 
@@ -124,8 +140,7 @@ async def fetch_spotify(url: str) -> Optional[Union[dict, List[str]]]:
     title = re.sub(
         r"(.*) - song( and lyrics)? by (.*) \| Spotify", r"\1 \3", title
     )
-    # use sync function because we're already in executor
-    results = loader._search_youtube(title)
+    results = await loader.search_youtube(title)
     return results[0] if results else None
 
 
@@ -135,7 +150,13 @@ async def fetch_spotify_playlist(
     """Returns list of Spotify links"""
 
     if spotify_api:
-        return fetch_playlist_with_api(SpotifyPlaylistTypes(list_type), code)
+        # spotipy makes blocking requests
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            fetch_playlist_with_api,
+            SpotifyPlaylistTypes(list_type),
+            code,
+        )
 
     soup = await get_soup(url)
     results = soup.find_all(attrs={"name": "music:song", "content": True})
@@ -146,6 +167,8 @@ async def fetch_spotify_playlist(
 def fetch_playlist_with_api(
     list_type: SpotifyPlaylistTypes, code: str
 ) -> List[str]:
+    """Returns list of Spotify links
+    Raises SpotifyException if Spotify throttles the bot"""
     tracks = []
     try:
         if list_type == SpotifyPlaylistTypes.ALBUM:
@@ -163,7 +186,10 @@ def fetch_playlist_with_api(
                 f" for {list_type} {code}",
                 file=sys.stderr,
             )
-    except Exception:
+    except Exception as e:
+        if isinstance(e, SpotifyException) and e.http_status == 429:
+            # let the loader back off
+            raise
         print(
             f"ERROR: Spotify API returned error for {list_type} {code}:",
             file=sys.stderr,
@@ -183,12 +209,69 @@ def fetch_playlist_with_api(
     return links
 
 
+# query parameters that don't change the content
+TRACKING_PARAMS = {"si", "feature", "pp", "fbclid"}
+TRACKING_PREFIX = "utm_"
+
+
+def normalize_url(url: str) -> str:
+    "Returns the URL in a form suitable to be used as a cache key"
+    parsed = urlparse(url.strip())
+    netloc = parsed.netloc.lower()
+    for prefix in ("www.", "m."):
+        if netloc.startswith(prefix):
+            netloc = netloc[len(prefix) :]
+    path = parsed.path
+    query = parse_qsl(parsed.query)
+    if netloc == "youtu.be":
+        netloc = "youtube.com"
+        query.append(("v", path.strip("/")))
+        path = "/watch"
+    query = sorted(
+        (k, v)
+        for k, v in query
+        if k not in TRACKING_PARAMS and not k.startswith(TRACKING_PREFIX)
+    )
+    return "https://{}{}{}".format(
+        netloc,
+        path.rstrip("/") or "/",
+        "?" + urlencode(query) if query else "",
+    )
+
+
 def get_urls(content: str) -> List[str]:
     return [m[0] for m in url_regex.findall(content)]
 
 
+def _valid_urls(ie: ExtractorT) -> Optional[List[str]]:
+    if ie.IE_NAME == "generic":
+        # never returned by get_ie
+        return []
+    patterns = ie._VALID_URL
+    if patterns is False:
+        return []
+    if isinstance(patterns, str):
+        return [patterns]
+    if isinstance(patterns, (list, tuple)):
+        return list(patterns)
+    return None
+
+
+def get_ie_index() -> HostIndex:
+    """Returns EXTRACTORS indexed by domains they support
+    Takes about a second to build, so it is built once per process"""
+    global _ie_index
+    with _ie_index_lock:
+        if _ie_index is None:
+            _ie_index = HostIndex(EXTRACTORS, _valid_urls)
+    return _ie_index
+
+
+@lru_cache(maxsize=IE_CACHE_SIZE)
 def get_ie(url: str) -> Optional[ExtractorT]:
-    for ie in EXTRACTORS:
+    # suitable() of extractors only narrows down their _VALID_URL,
+    # so the ones not listed for the URL can be skipped
+    for ie in get_ie_index().candidates(url):
         if ie.suitable(url) and ie.IE_NAME != "generic":
             return ie
     return None
@@ -1,19 +1,48 @@
+import os
+import re
 import sys
+import math
+import time
 import atexit
+import statistics
 import asyncio
 import threading
-from inspect import getmodule
+from copy import copy
+from enum import IntEnum
+from contextvars import ContextVar
+from itertools import count
+from collections import deque
 from urllib.request import urlparse
-from datetime import datetime, timezone
-from concurrent.futures import ProcessPoolExecutor
-from multiprocessing import get_context as mp_context
-from typing import List, Optional, Union
+from concurrent.futures import (
+    BrokenExecutor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from multiprocessing import get_all_start_methods, get_context as mp_context
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from aiohttp import ClientResponseError
+from spotipy import SpotifyException
 from yt_dlp import YoutubeDL, DownloadError
 
 from config import config
 from musicbot.song import Song
+from musicbot.cache import PersistentCache
+from musicbot.ratelimit import SiteLimiter, get_limiter
+from musicbot.ratelimit import stats as limiter_stats
 from musicbot.utils import OutputWrapper
 from musicbot.linkutils import (
     YT_IE,
@@ -21,8 +50,10 @@ from musicbot.linkutils import (
     Origins,
     SiteTypes,
     get_ie,
+    get_ie_index,
     fetch_spotify,
     identify_url,
+    normalize_url,
     init as init_session,
     stop as stop_session,
 )
@@ -31,7 +62,92 @@ from musicbot.linkutils import (
 sys.stdout = OutputWrapper(sys.stdout)
 sys.stderr = OutputWrapper(sys.stderr)
 
-_context = mp_context("spawn")
+
+def _start_method() -> str:
+    # processes forked from a server that has already imported
+    # everything start much faster than spawned ones
+    if "forkserver" in get_all_start_methods() and not getattr(
+        sys, "frozen", False
+    ):
+        return "forkserver"
+    return "spawn"
+
+
+_context = mp_context(_start_method())
+if _context.get_start_method() == "forkserver":
+    _context.set_forkserver_preload(["musicbot.forkserver"])
+
+# cached stream URLs are not used when they expire sooner than this
+URL_EXPIRY_MARGIN = 600
+# how long to keep stream URLs without known expiration time
+DEFAULT_URL_TTL = 3600
+CACHED_SONG_FIELDS = (
+    "webpage_url",
+    "url",
+    "title",
+    "uploader",
+    "duration",
+    "thumbnail",
+    "acodec",
+)
+CACHED_SEARCH_FIELDS = ("url", "title", "uploader", "duration")
+# songs are sent from workers as tuples of these fields,
+# bump the version when changing them
+RECORD_VERSION = 2
+RECORD_FIELDS = (
+    "webpage_url",
+    "url",
+    "title",
+    "uploader",
+    "duration",
+    "thumbnail",
+    "acodec",
+)
+# how many guilds with the longest waits are shown in stats
+STATS_GUILDS = 10
+# how many recent extraction times are kept per site
+LATENCY_SAMPLES = 100
+# extractions from a site are copied only after this many are timed
+MIN_LATENCY_SAMPLES = 20
+# errors of sites refusing requests because of their number
+_throttled_regex = re.compile(
+    r"HTTP Error 429|Too Many Requests|confirm you.re not a bot"
+    r"|rate.?limit",
+    re.IGNORECASE,
+)
+# other extraction errors by their kind, checked in order
+_error_regexes = (
+    (
+        "unsupported",
+        re.compile(r"Unsupported URL|is not a valid URL", re.IGNORECASE),
+    ),
+    # usually passing, e.g. YouTube checking for bots
+    # or refusing a format URL
+    (
+        "network",
+        re.compile(r"HTTP Error 403|try again later", re.IGNORECASE),
+    ),
+    # only songs that are really gone or blocked, cached the longest
+    (
+        "unavailable",
+        re.compile(
+            r"Private video|Video unavailable|This video is unavailable"
+            r"|no longer available|available in your country"
+            r"|been removed|been terminated|does not exist"
+            r"|members.only|confirm your age|HTTP Error 40[14]"
+            r"|HTTP Error 410",
+            re.IGNORECASE,
+        ),
+    ),
+    (
+        "network",
+        re.compile(
+            r"Unable to download|timed out|Connection|urlopen error"
+            r"|Temporary failure|HTTP Error 5\d\d",
+            re.IGNORECASE,
+        ),
+    ),
+)
 
 
 class LoaderProcess(_context.Process):
@@ -53,79 +169,593 @@ async def close_bot_session():
     await bot.http.close()
 
 
-_loop = asyncio.new_event_loop()
-_loop.run_until_complete(init_session())
-atexit.register(lambda: _loop.run_until_complete(stop_session()))
-atexit.register(lambda: _loop.run_until_complete(close_bot_session()))
-_executor = ProcessPoolExecutor(1, _context)
-_downloader = YoutubeDL(
-    {
-        "format": "bestaudio/best",
-        "extract_flat": True,
-        "noplaylist": True,
-        # default_search shouldn't be needed as long as
-        # we don't pass plain text to the downloader.
-        # still leaving it just in case
-        "default_search": "auto",
-        "cookiefile": config.COOKIE_PATH,
-        "quiet": True,
-    }
-)
-_preloading = {}
-_site_locks = {}
+# created on first use, the forkserver must not share it
+# with the processes forked from it
+_loop: Optional[asyncio.AbstractEventLoop] = None
+# thread workers share the loop, only one of them can run it at a time
+_loop_lock = threading.Lock()
+_downloader_options = {
+    # Opus can be sent to Discord without decoding
+    "format": "bestaudio[acodec=opus]/bestaudio/best",
+    "extract_flat": True,
+    "noplaylist": True,
+    # default_search shouldn't be needed as long as
+    # we don't pass plain text to the downloader.
+    # still leaving it just in case
+    "default_search": "auto",
+    "cookiefile": config.COOKIE_PATH,
+    "quiet": True,
+}
+# every worker thread gets its own downloader
+_local = threading.local()
+_bot = None
+_song_cache = PersistentCache("songs", config.SONG_CACHE_SIZE)
+_search_cache = PersistentCache("searches", config.SEARCH_CACHE_SIZE)
+_failure_cache = PersistentCache("failures", config.FAILURE_CACHE_SIZE)
 
 
 class SongError(Exception):
     pass
 
 
-def _noop():
-    pass
+class ThrottledError(SongError):
+    """The site refused the request because of too many requests
+    Retrying it later can succeed"""
+
+
+class ExtractionError(SongError):
+    """Extraction failed, the kind of failure decides how long
+    it is cached for"""
+
+    def __init__(self, kind: str):
+        super().__init__(config.SONGINFO_ERROR)
+        self.kind = kind
+
+    def __reduce__(self):
+        # keep the kind when passed from worker processes
+        return type(self), (self.kind,)
+
+
+class Priority(IntEnum):
+    """Order in which waiting jobs get free workers"""
+
+    # the song that is about to play
+    NEXT = 0
+    # requests of users waiting for a reply
+    INTERACTIVE = 1
+    # preloads and refreshes
+    BACKGROUND = 2
+
+
+class Flight:
+    """Extraction shared by concurrent requests for the same resource"""
+
+    def __init__(
+        self,
+        priority: Priority,
+        guild: Optional[int],
+        deadline: float,
+        parent: Optional["Flight"],
+    ):
+        self.task: Optional[asyncio.Future] = None
+        self.waiters = 0
+        self._priority = priority
+        # the guild that started it is charged for its jobs
+        self.guild = guild
+        self._deadline = deadline
+        # flight that started this one, its priority and deadline
+        # are inherited
+        self.parent = parent
+
+    @property
+    def priority(self) -> Priority:
+        if self.parent is None:
+            return self._priority
+        return min(self._priority, self.parent.priority)
+
+    @property
+    def deadline(self) -> float:
+        if self.parent is None:
+            return self._deadline
+        return max(self._deadline, self.parent.deadline)
+
+    def join(self, priority: Priority, deadline: float):
+        "Updates the flight for a new request"
+        self._priority = min(self._priority, priority)
+        self._deadline = max(self._deadline, deadline)
+
+
+# flight run by the current task
+_current_flight: ContextVar[Optional[Flight]] = ContextVar(
+    "current_flight", default=None
+)
+
+
+class Job:
+    def __init__(
+        self,
+        site: str,
+        func: Callable,
+        args: tuple,
+        timeout: float,
+        priority: Priority,
+        guild: Optional[int],
+        deadline: float,
+    ):
+        self.site = site
+        self.func = func
+        self.args = args
+        self.timeout = timeout
+        self._priority = priority
+        self.guild = guild
+        self._deadline = deadline
+        # the flight may be joined by more urgent requests later
+        self.flight = _current_flight.get()
+        self.queued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def priority(self) -> Priority:
+        if self.flight is None:
+            return self._priority
+        return min(self._priority, self.flight.priority)
+
+    @property
+    def deadline(self) -> float:
+        "time.monotonic() after which the job isn't worth starting"
+        if self.flight is None:
+            return self._deadline
+        return max(self._deadline, self.flight.deadline)
+
+
+class GuildStats:
+    """Time jobs of a guild spent waiting for a worker"""
+
+    _turns = count(1)
+
+    def __init__(self):
+        self.jobs = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        # when the guild was served last, relative to the others
+        self.last_turn = 0
+
+    def add(self, wait: float):
+        self.last_turn = next(self._turns)
+        self.jobs += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def describe(self) -> str:
+        return (
+            f"{self.jobs} jobs, waited {self.total_wait / self.jobs:.2f}s"
+            f" on average, {self.max_wait:.2f}s at most"
+        )
+
+
+class Worker:
+    """Runs extraction jobs in a dedicated process or thread"""
+
+    _ids = count(1)
+
+    def __init__(self):
+        self.id = next(self._ids)
+        # threads can't be stopped, stuck ones are only abandoned
+        self.in_process = not config.EXTRACTION_USE_THREADS
+        if self.in_process:
+            self.executor = ProcessPoolExecutor(1, _context)
+        else:
+            self.executor = ThreadPoolExecutor(1, f"loader-{self.id}")
+        self.jobs_done = 0
+        self.job: Optional[Job] = None
+        self.job_started = 0.0
+        # memory used by the process after the last job, in bytes
+        self.rss: Optional[int] = None
+        # seconds it took to be ready for the first job
+        self.start_time: Optional[float] = None
+
+    def start(self):
+        "Starts the process and prepares it for the first job"
+        started = time.monotonic()
+
+        def ready(future):
+            if not future.exception():
+                self.start_time = time.monotonic() - started
+                _start_times.append(self.start_time)
+
+        self.executor.submit(_warm_up).add_done_callback(ready)
+
+    async def run(self, job: Job) -> Any:
+        self.job = job
+        self.job_started = time.monotonic()
+        try:
+            result, rss = await asyncio.get_running_loop().run_in_executor(
+                self.executor, _run_job, job.func, job.args
+            )
+        finally:
+            self.job = None
+            self.jobs_done += 1
+        if self.in_process:
+            self.rss = rss
+        return result
+
+    def needs_recycling(self) -> bool:
+        if config.WORKER_MAX_JOBS and self.jobs_done >= config.WORKER_MAX_JOBS:
+            return True
+        return bool(
+            config.WORKER_MAX_MEMORY
+            and self.rss
+            and self.rss > config.WORKER_MAX_MEMORY * 2**20
+        )
+
+    def stop(self):
+        "Lets the worker exit after its current job"
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def kill(self):
+        if self.in_process:
+            # there's no public way to stop a running job
+            for process in list((self.executor._processes or {}).values()):
+                process.kill()
+        self.stop()
+
+    def describe(self) -> str:
+        if self.job:
+            elapsed = time.monotonic() - self.job_started
+            state = f"busy with {self.job.site} for {elapsed:.1f}s"
+        else:
+            state = "idle"
+        state += f", {self.jobs_done} jobs done"
+        if self.start_time is not None:
+            state += f", started in {self.start_time * 1000:.0f} ms"
+        if self.rss:
+            state += f", {self.rss / 2**20:.0f} MB"
+        return state
+
 
+_workers: List[Worker] = []
+# started in advance to replace the next killed or recycled worker
+_standby: Optional[Worker] = None
+_idle_workers: List[Worker] = []
+_pending: Deque[Job] = deque()
+# number of running jobs per site
+_site_jobs: Dict[str, int] = {}
+# number of running jobs per guild
+_guild_jobs: Dict[Optional[int], int] = {}
+_guild_stats: Dict[Optional[int], GuildStats] = {}
+# according to Python documentation, we need
+# to keep strong references to all tasks
+_tasks = set()
+_flights: Dict[Hashable, Flight] = {}
+# how many requests joined an extraction started by another one
+_shared_flights = 0
+# jobs dropped because nobody waited for them anymore
+_expired_jobs = 0
+_finished_jobs = 0
+# recent durations of successful jobs per site
+_latencies: Dict[str, Deque[float]] = {}
+# copies of slow jobs started, and how many of them finished first
+_hedges = 0
+_hedge_wins = 0
+# wakes the scheduler when paused sites can be tried again
+_dispatch_timer: Optional[asyncio.TimerHandle] = None
+# workers replaced because of stuck or cancelled jobs
+_killed_workers = 0
+# workers replaced because of their job count or memory usage
+_recycled_workers = 0
+# how long recent workers took to start
+_start_times: Deque[float] = deque(maxlen=LATENCY_SAMPLES)
 
-def init():
-    # wake it up to spawn the process immediately
-    _executor.submit(_noop).result()
+
+def _warm_up():
+    get_ie_index()
+    _get_downloader()
+
+
+def _run_job(func: Callable, args: tuple) -> Tuple[Any, Optional[int]]:
+    "Runs the job in the worker, returns its result and the worker's memory"
+    return func(*args), _get_rss()
+
+
+def _get_rss() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    # peak usage, good enough to notice a leak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def init(bot=None):
+    """Starts the workers in the background,
+    jobs given to them before they are ready wait in their queues"""
+    global _bot, _standby
+    _bot = bot
+    _workers.extend(Worker() for _ in range(config.EXTRACTION_WORKERS))
+    _idle_workers.extend(_workers)
+    # threads start instantly
+    if not config.EXTRACTION_USE_THREADS:
+        _standby = Worker()
+    # starting processes waits for the forkserver to import everything,
+    # do it while the bot connects
+    threading.Thread(target=_start_workers, daemon=True).start()
+
+
+def _start_workers():
+    for worker in _workers:
+        worker.start()
+    if _standby:
+        _standby.start()
+    # main process needs it as well to identify links in messages
+    get_ie_index()
+
+
+def get_bot():
+    "Returns the bot, or its logged out copy in worker processes"
+    if _bot is None:
+        from musicbot.__main__ import bot
+
+        return bot
+    return _bot
+
+
+def _get_downloader() -> YoutubeDL:
+    try:
+        return _local.downloader
+    except AttributeError:
+        _local.downloader = YoutubeDL(_downloader_options)
+        return _local.downloader
+
+
+def _run_coro(coro):
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.run_until_complete(init_session())
+            atexit.register(_close_loop)
+        return _loop.run_until_complete(coro)
+
+
+def _close_loop():
+    _loop.run_until_complete(close_bot_session())
+    _loop.run_until_complete(stop_session())
+
+
+def _get_site(host: Union[SiteTypes, ExtractorT]) -> str:
+    "Returns the name used to limit concurrent extractions"
+    if host == SiteTypes.NOT_URL:
+        host = YT_IE
+    elif isinstance(host, SiteTypes):
+        return host.name.lower()
+    # extractor *may* be lazy, avoid loading the real class
+    module = getattr(host, "_module", host.__module__)
+    return module.rpartition(".")[2]
+
+
+def _site_limit(site: str) -> int:
+    return config.SITE_EXTRACTION_LIMITS.get(
+        site, config.MAX_SITE_EXTRACTIONS
+    )
 
 
 def extract_info(url: str, ie: Optional[ExtractorT] = None) -> Optional[dict]:
     if ie is None:
         ie = get_ie(url)
-    # cache by module (effectively means by site)
-    # extractor *may* be lazy
-    module = getmodule(getattr(ie, "real_class", ie))
     try:
-        lock = _site_locks[module]
-    except KeyError:
-        lock = _site_locks[module] = threading.Lock()
-    with lock:
-        try:
-            return _downloader.extract_info(url, False, ie.ie_key())
-        except DownloadError:
-            return None
+        return _get_downloader().extract_info(url, False, ie.ie_key())
+    except DownloadError as e:
+        raise _classify_error(e) from None
+
+
+def _classify_error(error: DownloadError) -> SongError:
+    message = str(error)
+    if _throttled_regex.search(message):
+        return ThrottledError(config.SONGINFO_THROTTLED)
+    for kind, regex in _error_regexes:
+        if regex.search(message):
+            return ExtractionError(kind)
+    return ExtractionError("error")
+
+
+async def search_youtube(
+    title: str,
+    count: int = 1,
+    priority: Optional[Priority] = None,
+    guild: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> Optional[dict]:
+    """Returns info of the first `count` results
+    Raises SongError if the search doesn't start before `deadline`"""
+    key = " ".join(title.casefold().split())
+    cached = _search_cache.get(key)
+    # bigger search can answer smaller one
+    if cached and cached["count"] >= count:
+        return cached["entries"][:count]
+    return await _coalesce(
+        ("search", key, count),
+        priority,
+        guild,
+        deadline,
+        _fetch_search,
+        key,
+        title,
+        count,
+    )
 
 
-async def search_youtube(title: str, count: int = 1) -> Optional[dict]:
-    return await _run_sync(_search_youtube, title, count)
+async def _fetch_search(key: str, title: str, count: int) -> Optional[dict]:
+    entries = await _run_sync(
+        _get_site(SiteTypes.NOT_URL),
+        _search_youtube,
+        title,
+        count,
+        hedge=True,
+    )
+    if entries:
+        _search_cache.put(
+            key,
+            {"count": count, "entries": entries},
+            config.SEARCH_CACHE_TTL,
+        )
+    return entries
+
+
+def _project_info(info: dict, fields: Iterable[str]) -> dict:
+    "Returns only the fields of yt-dlp info that are used by the bot"
+    result = {field: info.get(field) for field in fields}
+    thumbnails = info.get("thumbnails")
+    if thumbnails:
+        # last thumbnail has the best resolution
+        result["thumbnail"] = thumbnails[-1]["url"]
+    return result
 
 
 def _search_youtube(title: str, count: int = 1) -> Optional[dict]:
     """Searches youtube for the video title
     Returns the first results video link"""
 
-    r = extract_info(f"ytsearch{count}:{title}")
+    try:
+        r = extract_info(f"ytsearch{count}:{title}")
+    except ExtractionError:
+        return None
 
     if not r:
         return None
 
-    return r["entries"]
+    return [
+        _project_info(entry, CACHED_SEARCH_FIELDS) for entry in r["entries"]
+    ]
+
+
+async def load_song(
+    track: str,
+    priority: Optional[Priority] = None,
+    guild: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> Union[Optional[Song], List[Song]]:
+    host = identify_url(track)
+    if host == SiteTypes.UNKNOWN:
+        return None
+    if host == SiteTypes.NOT_URL:
+        results = await search_youtube(track, 1, priority, guild, deadline)
+        if not results:
+            return None
+        track = results[0]["url"]
+        host = identify_url(track)
+    song = _get_cached_song(track, False)
+    if song:
+        return song
+    return await _fetch_song(track, host, priority, guild, deadline)
+
+
+async def _fetch_song(
+    track: str,
+    host: Union[SiteTypes, ExtractorT],
+    priority: Optional[Priority],
+    guild: Optional[int],
+    deadline: Optional[float] = None,
+) -> Union[Optional[Song], List[Song]]:
+    _check_failure(track)
+    result = await _coalesce(
+        ("song", normalize_url(track)),
+        priority,
+        guild,
+        deadline,
+        _extract_song,
+        track,
+        host,
+    )
+    # the result is shared, give every caller its own songs
+    if isinstance(result, list):
+        return [copy(song) for song in result]
+    return copy(result)
+
+
+async def _extract_song(
+    track: str, host: Union[SiteTypes, ExtractorT]
+) -> Union[Optional[Song], List[Song]]:
+    try:
+        if _is_async(host):
+            result = await _load_song_async(track, host)
+        else:
+            result = _unpack_songs(
+                await _run_sync(_get_site(host), _load_song, track, hedge=True)
+            )
+    except ExtractionError as e:
+        _cache_failure(track, e)
+        raise
+    if isinstance(result, Song):
+        _cache_song(result, track)
+    return result
+
+
+def _check_failure(track: str):
+    "Raises the error of the last attempt to load the track if cached"
+    kind = _failure_cache.get(normalize_url(track))
+    if kind is not None:
+        raise ExtractionError(kind)
 
 
-async def load_song(track: str) -> Union[Optional[Song], List[Song]]:
-    return await _run_sync(_load_song, track)
+def _cache_failure(track: str, error: ExtractionError):
+    ttl = config.FAILURE_CACHE_TTLS.get(error.kind)
+    if ttl:
+        _failure_cache.put(normalize_url(track), error.kind, ttl)
 
 
-def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
+def _get_cached_song(
+    track: str, need_url: bool, margin: float = URL_EXPIRY_MARGIN
+) -> Optional[Song]:
+    data = _song_cache.get(normalize_url(track))
+    if data is None:
+        return None
+    url = data["url"]
+    if data["url_expires"] < time.time() + margin:
+        if need_url:
+            return None
+        url = None
+    return Song(
+        Origins.Default,
+        SiteTypes[data["host"]],
+        webpage_url=data["webpage_url"],
+        url=url,
+        title=data["title"],
+        uploader=data["uploader"],
+        duration=data["duration"],
+        thumbnail=data["thumbnail"],
+        # absent in songs cached by older versions
+        acodec=data.get("acodec"),
+    )
+
+
+def _cache_song(song: Song, *aliases: str):
+    "Caches song info by its URL and optional aliases"
+    if not isinstance(song.host, SiteTypes) or song.webpage_url is None:
+        return
+    data = {field: getattr(song, field) for field in CACHED_SONG_FIELDS}
+    data["host"] = song.host.name
+    # static info lives much longer than the stream URL
+    if song.url is None:
+        data["url_expires"] = 0
+    elif song.url == song.webpage_url:
+        data["url_expires"] = time.time() + config.SONG_CACHE_TTL
+    else:
+        data["url_expires"] = _parse_expire(song.url) or (
+            time.time() + DEFAULT_URL_TTL
+        )
+    for url in {song.webpage_url, *aliases}:
+        _song_cache.put(normalize_url(url), data, config.SONG_CACHE_TTL)
+
+
+def _load_song(track: str) -> Optional[tuple]:
+    "Loads the track in a worker, returns it packed by _pack_songs"
     host = identify_url(track)
 
     if host == SiteTypes.NOT_URL:
@@ -138,11 +768,50 @@ def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
     elif host == SiteTypes.UNKNOWN:
         return None
 
-    elif host == SiteTypes.SPOTIFY:
+    else:  # host is info extractor
+        data = extract_info(track, host)
+        host = SiteTypes.YT_DLP
+
+    return _pack_songs(_make_result(data, host, track))
+
+
+def _extract_compact_info(url: str, ie: ExtractorT) -> Optional[dict]:
+    "extract_info without the fields the bot doesn't use, like formats"
+    data = extract_info(url, ie)
+    if not data:
+        return None
+    return _project_info(data, RECORD_FIELDS)
+
+
+def _is_async(host: Union[SiteTypes, ExtractorT]) -> bool:
+    """Returns whether songs from the host are loaded with HTTP requests
+    in the main process instead of yt-dlp extraction in a worker"""
+    if isinstance(host, SiteTypes):
+        return host in (SiteTypes.SPOTIFY, SiteTypes.CUSTOM)
+    # extractor *may* be lazy, avoid loading the real class
+    return "async_extract" in vars(host)
+
+
+async def _load_song_async(
+    track: str, host: Union[SiteTypes, ExtractorT]
+) -> Union[Optional[Song], List[Song]]:
+    if host == SiteTypes.SPOTIFY:
+        limiter = get_limiter(_get_site(host))
+        await _wait_for_limiter(limiter)
         try:
-            data = _loop.run_until_complete(fetch_spotify(track))
+            data = await fetch_spotify(track)
+        except SpotifyException as e:
+            # only raised when throttled
+            limiter.throttle(time.monotonic())
+            raise ThrottledError(config.SONGINFO_THROTTLED) from e
         except ClientResponseError as e:
-            raise SongError(config.SONGINFO_ERROR) from e
+            if e.status == 429:
+                limiter.throttle(time.monotonic())
+                raise ThrottledError(config.SONGINFO_THROTTLED) from e
+            if e.status in (400, 404):
+                raise ExtractionError("unavailable") from e
+            raise ExtractionError("network") from e
+        limiter.success()
         if isinstance(data, list):
             data = [{"url": url} for url in data]
 
@@ -153,10 +822,46 @@ def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
             "title": urlparse(track).path.rpartition("/")[2],
         }
 
-    else:  # host is info extractor
-        data = extract_info(track, host)
+    else:  # host is plugin extractor
+        try:
+            data = await host.async_extract(track)
+        except DownloadError as e:
+            raise _classify_error(e) from None
         host = SiteTypes.YT_DLP
 
+    if isinstance(data, dict) and "entries" not in data:
+        if YT_IE.suitable(data["url"]):
+            # the URL wasn't extracted, hop to the worker for that
+            data = await _run_sync(
+                _get_site(YT_IE),
+                _extract_compact_info,
+                data["url"],
+                YT_IE,
+                hedge=True,
+            )
+    return _make_result(data, host, track)
+
+
+async def _wait_for_limiter(limiter: SiteLimiter):
+    """Takes a token of a site requested from the main process
+    Raises ThrottledError if its circuit is open"""
+    while True:
+        now = time.monotonic()
+        if limiter.is_open(now):
+            raise ThrottledError(config.SONGINFO_THROTTLED)
+        wait = limiter.wait_time(now)
+        if wait <= 0:
+            break
+        # others waiting as long may have taken the token first
+        await asyncio.sleep(wait)
+    limiter.take(now)
+
+
+def _make_result(
+    data: Optional[Union[dict, List[dict]]],
+    host: SiteTypes,
+    track: str,
+) -> Union[Song, List[Song]]:
     if not data:
         raise SongError(config.SONGINFO_ERROR)
 
@@ -171,17 +876,7 @@ def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
                 raise SongError(config.SONGINFO_ERROR)
 
     if isinstance(data, list):
-        results = []
-        for entry in data:
-            entry.pop("webpage_url", None)
-            song = Song(
-                Origins.Playlist,
-                host,
-                webpage_url=entry.pop("url"),
-            )
-            song.update(entry)
-            results.append(song)
-        return results
+        return _make_songs(data, host)
 
     song = Song(Origins.Default, host, webpage_url=track)
     song.update(data)
@@ -189,6 +884,184 @@ def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
     return song
 
 
+def _pack_songs(
+    result: Union[Optional[Song], List[Song]]
+) -> Optional[tuple]:
+    """Encodes songs to be sent from a worker with little pickling
+    Lists are stored by fields, so that the same values repeat less"""
+    if result is None:
+        return None
+    if isinstance(result, Song):
+        fields = tuple(getattr(result, field) for field in RECORD_FIELDS)
+        return (RECORD_VERSION, False, result.host.name, fields)
+    host = result[0].host if result else SiteTypes.YT_DLP
+    columns = tuple(
+        tuple(getattr(song, field) for song in result)
+        for field in RECORD_FIELDS
+    )
+    return (RECORD_VERSION, True, host.name, columns)
+
+
+def _unpack_songs(
+    record: Optional[tuple],
+) -> Union[Optional[Song], List[Song]]:
+    if record is None:
+        return None
+    version, is_list, host, fields = record
+    if version != RECORD_VERSION:
+        raise SongError(config.SONGINFO_ERROR)
+    host = SiteTypes[host]
+    if not is_list:
+        return Song(Origins.Default, host, **dict(zip(RECORD_FIELDS, fields)))
+    return [
+        Song(Origins.Playlist, host, **dict(zip(RECORD_FIELDS, values)))
+        for values in zip(*fields)
+    ]
+
+
+def _make_songs(entries: Iterable[dict], host: SiteTypes) -> List[Song]:
+    results = []
+    for entry in entries:
+        entry.pop("webpage_url", None)
+        song = Song(
+            Origins.Playlist,
+            host,
+            webpage_url=entry.pop("url"),
+        )
+        song.update(entry)
+        results.append(song)
+    return results
+
+
+class SongStream:
+    """Async iterator over the result of a track, playlists are yielded
+    in pages that are extracted only when the next one is requested"""
+
+    def __init__(
+        self,
+        track: str,
+        priority: Optional[Priority],
+        guild: Optional[int],
+        deadline: Optional[float],
+    ):
+        self.track = track
+        self.priority = priority
+        self.guild = guild
+        self.deadline = deadline
+        # playlist entries that weren't yielded yet, None if unknown
+        self.pending: Optional[int] = None
+        self._pages = self._iter()
+
+    def __aiter__(self) -> "SongStream":
+        return self
+
+    def __anext__(self) -> Awaitable[Union[Song, List[Song]]]:
+        return self._pages.__anext__()
+
+    async def _iter(self) -> AsyncIterator[Union[Song, List[Song]]]:
+        track = self.track
+        host = identify_url(track)
+        if isinstance(host, SiteTypes) or _is_async(host):
+            result = await load_song(
+                track, self.priority, self.guild, self.deadline
+            )
+            # loaded at once, nothing is left for later
+            self.pending = 0
+            if result:
+                yield result
+            return
+
+        song = _get_cached_song(track, False)
+        if song:
+            self.pending = 0
+            yield song
+            return
+        _check_failure(track)
+
+        start = 1
+        size = config.PLAYLIST_CHUNK_SIZE
+        while True:
+            try:
+                record, total = await _coalesce(
+                    ("page", normalize_url(track), start, size),
+                    self.priority,
+                    self.guild,
+                    self.deadline,
+                    _fetch_page,
+                    _get_site(host),
+                    track,
+                    start,
+                    size,
+                )
+            except ExtractionError as e:
+                if start == 1:
+                    _cache_failure(track, e)
+                raise
+            result = _unpack_songs(record)
+            if not isinstance(result, list):
+                if result:
+                    _cache_song(result, track)
+                    yield result
+                return
+
+            start += size
+            if total is not None:
+                self.pending = max(total - start + 1, 0)
+            if result:
+                yield result
+            if self.pending == 0 or total is None and not result:
+                return
+            # the user is already listening to the first page
+            self.priority = Priority.BACKGROUND
+            self.deadline = None
+
+
+def iter_song(
+    track: str,
+    priority: Optional[Priority] = None,
+    guild: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> SongStream:
+    """Same as load_song, but yields playlists from extractors in pages
+    of PLAYLIST_CHUNK_SIZE songs, each extracted when it's requested"""
+    return SongStream(track, priority, guild, deadline)
+
+
+async def _fetch_page(
+    site: str, track: str, start: int, size: int
+) -> Tuple[Optional[tuple], Optional[int]]:
+    return await _run_sync(
+        site,
+        _load_page,
+        track,
+        start,
+        size,
+        # the first page may be a single song, the user is waiting for it
+        timeout=None if start == 1 else config.PLAYLIST_EXTRACTION_TIMEOUT,
+        hedge=start == 1,
+    )
+
+
+def _load_page(
+    track: str, start: int, size: int
+) -> Tuple[Optional[tuple], Optional[int]]:
+    """Extracts `size` playlist entries from `start`, counted from 1
+    Returns them packed with the playlist length if it's known,
+    tracks that aren't playlists are returned whole"""
+    downloader = _get_downloader()
+    downloader.params["playlist_items"] = f"{start}:{start + size - 1}"
+    try:
+        data = extract_info(track)
+    finally:
+        del downloader.params["playlist_items"]
+    if not data or "entries" not in data:
+        return _pack_songs(_make_result(data, SiteTypes.YT_DLP, track)), None
+    # unavailable videos are None
+    entries = [entry for entry in data["entries"] if entry]
+    songs = _make_songs(entries, SiteTypes.YT_DLP)
+    return _pack_songs(songs), data.get("playlist_count")
+
+
 def _parse_expire(url: str) -> Optional[int]:
     expire = (
         ("&" + urlparse(url).query).partition("&expire=")[2].partition("&")[0]
@@ -199,26 +1072,50 @@ def _parse_expire(url: str) -> Optional[int]:
         return None
 
 
-async def preload(song: Song) -> bool:
+def expires_in(song: Song) -> Optional[float]:
+    """Returns how many seconds the stream URL of the song stays valid
+    None means the URL wasn't loaded yet"""
+    if song.url is None:
+        return None
+    expire = _parse_expire(song.url)
+    if expire is None or expire == _parse_expire(song.webpage_url):
+        return math.inf
+    return expire - time.time()
+
+
+async def preload(
+    song: Song,
+    margin: float = 0,
+    priority: Priority = Priority.BACKGROUND,
+    guild: Optional[int] = None,
+) -> bool:
+    """Loads stream URL of the song unless it's valid for `margin` seconds
+    Returns whether the song can be played
+    Raises ThrottledError if it can't be said now"""
     if song.webpage_url is None:
         return True
 
-    if song.url is not None:
-        expire = _parse_expire(song.url)
-        if expire is None or expire == _parse_expire(song.webpage_url):
-            return True
-        if datetime.now(timezone.utc) < datetime.fromtimestamp(
-            expire, timezone.utc
-        ):
-            return True
+    expires = expires_in(song)
+    if expires is not None and expires > margin:
+        return True
 
-    future = _preloading.get(song)
-    if future:
-        return await future
-    _preloading[song] = asyncio.Future()
+    cached = _get_cached_song(
+        song.webpage_url, True, max(margin, URL_EXPIRY_MARGIN)
+    )
+    if cached:
+        song.update(cached)
+        return True
 
     try:
-        preloaded = await load_song(song.webpage_url)
+        host = identify_url(song.webpage_url)
+        if host == SiteTypes.UNKNOWN:
+            preloaded = None
+        else:
+            preloaded = await _fetch_song(
+                song.webpage_url, host, priority, guild
+            )
+    except ThrottledError:
+        raise
     except SongError:
         success = False
     else:
@@ -226,12 +1123,390 @@ async def preload(song: Song) -> bool:
 
     if success:
         song.update(preloaded)
-
-    _preloading.pop(song).set_result(success)
     return success
 
 
-async def _run_sync(f, *args):
-    return await asyncio.get_running_loop().run_in_executor(
-        _executor, f, *args
+def is_busy() -> bool:
+    "Returns whether user requests are waiting for a free worker"
+    return any(job.priority < Priority.BACKGROUND for job in _pending)
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    "Returns loader metrics grouped by component"
+    return {
+        "song cache": _song_cache.stats(),
+        "search cache": _search_cache.stats(),
+        "failure cache": _failure_cache.stats(),
+        "extractions": {
+            "in progress": len(_flights),
+            "shared": _shared_flights,
+            "expired": _expired_jobs,
+        },
+        "hedging": {
+            "copies started": _hedges,
+            "copies won": _hedge_wins,
+            **{
+                f"delay {site}": f"{delay:.1f}s"
+                for site, delay in (
+                    (site, _hedge_delay(site)) for site in sorted(_latencies)
+                )
+                if delay is not None
+            },
+        },
+        "workers": {
+            **{
+                f"queued {priority.name.lower()}": sum(
+                    job.priority == priority for job in _pending
+                )
+                for priority in Priority
+            },
+            "killed": _killed_workers,
+            "recycled": _recycled_workers,
+            **(
+                {"start time": _describe_start_times()}
+                if _start_times
+                else {}
+            ),
+            **{f"#{worker.id}": worker.describe() for worker in _workers},
+            **(
+                {f"#{_standby.id} (standby)": _standby.describe()}
+                if _standby
+                else {}
+            ),
+        },
+        "rate limits": limiter_stats(),
+        "guild waits": {
+            guild or "no guild": guild_stats.describe()
+            for guild, guild_stats in sorted(
+                _guild_stats.items(),
+                key=lambda item: item[1].total_wait / item[1].jobs,
+                reverse=True,
+            )[:STATS_GUILDS]
+        },
+    }
+
+
+def _describe_start_times() -> str:
+    return (
+        f"{statistics.mean(list(_start_times)) * 1000:.0f} ms on average,"
+        f" {max(_start_times) * 1000:.0f} ms at most"
     )
+
+
+def _dispatch():
+    """Starts pending jobs on idle workers by priority, respecting limits
+    Jobs of the same priority are taken from guilds in turns
+    Background jobs leave reserved workers for more urgent ones"""
+    global _expired_jobs, _dispatch_timer
+    now = time.monotonic()
+    for job in list(_pending):
+        if job.deadline <= now:
+            _pending.remove(job)
+            _expired_jobs += 1
+            job.future.set_exception(SongError(config.SONGINFO_EXPIRED))
+        elif get_limiter(job.site).is_open(now):
+            _pending.remove(job)
+            job.future.set_exception(
+                ThrottledError(config.SONGINFO_THROTTLED)
+            )
+    # when the first paused site can be tried again
+    retry_in = math.inf
+
+    reserved = min(config.RESERVED_EXTRACTION_WORKERS, len(_workers) - 1)
+    # n-th job of a guild, counting its running ones, waits for
+    # all jobs of other guilds that are earlier in their turn,
+    # ties go to the guild that was served least recently
+    turns: Dict[Any, int] = {}
+    ranks: Dict[Job, tuple] = {}
+    for job in _pending:
+        key = (job.priority, job.guild)
+        turn = turns.get(key, _guild_jobs.get(job.guild, 0))
+        turns[key] = turn + 1
+        guild_stats = _guild_stats.get(job.guild)
+        ranks[job] = (
+            job.priority,
+            turn,
+            guild_stats.last_turn if guild_stats else 0,
+        )
+    # sorting is stable, jobs with the same rank stay in FIFO order
+    for job in sorted(_pending, key=ranks.__getitem__):
+        if not _idle_workers:
+            break
+        if job.priority == Priority.BACKGROUND and (
+            len(_idle_workers) <= reserved
+        ):
+            break
+        if _site_jobs.get(job.site, 0) >= _site_limit(job.site):
+            continue
+        if (
+            job.priority != Priority.NEXT
+            and config.MAX_GUILD_EXTRACTIONS
+            and _guild_jobs.get(job.guild, 0) >= config.MAX_GUILD_EXTRACTIONS
+        ):
+            continue
+        limiter = get_limiter(job.site)
+        wait = limiter.wait_time(now)
+        if wait > 0:
+            retry_in = min(retry_in, wait)
+            continue
+        limiter.take(now)
+        _pending.remove(job)
+        _site_jobs[job.site] = _site_jobs.get(job.site, 0) + 1
+        _guild_jobs[job.guild] = _guild_jobs.get(job.guild, 0) + 1
+        if job.guild not in _guild_stats:
+            _guild_stats[job.guild] = GuildStats()
+        job.started_at = time.monotonic()
+        _guild_stats[job.guild].add(job.started_at - job.queued_at)
+        task = asyncio.ensure_future(_execute(_idle_workers.pop(), job))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.remove)
+
+    if _dispatch_timer:
+        _dispatch_timer.cancel()
+        _dispatch_timer = None
+    if retry_in != math.inf:
+        _dispatch_timer = asyncio.get_running_loop().call_later(
+            retry_in, _dispatch
+        )
+
+
+async def _execute(worker: Worker, job: Job):
+    """Runs the job, replacing the worker if it gets stuck or broken
+    Cancelled jobs are left to finish, restarting a process worker
+    costs more than the rest of the job"""
+    global _finished_jobs
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + job.timeout
+    run = asyncio.ensure_future(worker.run(job))
+    try:
+        await asyncio.wait(
+            (run, job.future),
+            timeout=job.timeout,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if not run.done() and job.future.done():
+            # cancelled, the result is dropped
+            await asyncio.wait((run,), timeout=deadline - loop.time())
+
+        if not run.done():
+            if not job.future.done():
+                print(
+                    f"Extraction from {job.site} timed out, "
+                    f"restarting worker #{worker.id}",
+                    file=sys.stderr,
+                )
+                job.future.set_exception(SongError(config.SONGINFO_ERROR))
+            run.cancel()
+            worker = _replace_worker(worker, kill=True)
+        elif isinstance(run.exception(), BrokenExecutor):
+            # the process died, e.g. killed by the OS
+            if not job.future.done():
+                job.future.set_exception(SongError(config.SONGINFO_ERROR))
+            worker = _replace_worker(worker, kill=True)
+        else:
+            limiter = get_limiter(job.site)
+            if isinstance(run.exception(), ThrottledError):
+                limiter.throttle(time.monotonic())
+            else:
+                limiter.success()
+            if not run.exception():
+                _latencies.setdefault(
+                    job.site, deque(maxlen=LATENCY_SAMPLES)
+                ).append(time.monotonic() - job.started_at)
+            if not job.future.done():
+                if run.exception():
+                    job.future.set_exception(run.exception())
+                else:
+                    job.future.set_result(run.result())
+            if worker.needs_recycling():
+                worker = _replace_worker(worker, kill=False)
+    finally:
+        _finished_jobs += 1
+        _site_jobs[job.site] -= 1
+        _guild_jobs[job.guild] -= 1
+        if not _guild_jobs[job.guild]:
+            del _guild_jobs[job.guild]
+        _idle_workers.append(worker)
+        _dispatch()
+
+
+def _replace_worker(worker: Worker, kill: bool) -> Worker:
+    global _killed_workers, _recycled_workers, _standby
+    if kill:
+        worker.kill()
+        _killed_workers += 1
+    else:
+        worker.stop()
+        _recycled_workers += 1
+    if _standby is None:
+        new_worker = Worker()
+        new_worker.start()
+    else:
+        new_worker = _standby
+        _standby = Worker()
+        _standby.start()
+    _workers[_workers.index(worker)] = new_worker
+    return new_worker
+
+
+async def _coalesce(
+    key: Hashable,
+    priority: Optional[Priority],
+    guild: Optional[int],
+    deadline: Optional[float],
+    f: Callable,
+    *args,
+) -> Any:
+    """Runs coroutine function f once for concurrent calls with the same key
+    It is cancelled only when all of the callers are cancelled
+    and runs with the highest priority and latest deadline of them"""
+    global _shared_flights
+    parent = _current_flight.get()
+    # inherit from the parent flight, if there is one
+    if priority is None:
+        priority = Priority.BACKGROUND if parent else Priority.INTERACTIVE
+    if deadline is None:
+        deadline = -math.inf if parent else math.inf
+    if guild is None and parent:
+        guild = parent.guild
+    flight = _flights.get(key)
+    if flight is None:
+        flight = _flights[key] = Flight(priority, guild, deadline, parent)
+        flight.task = asyncio.ensure_future(_fly(flight, f, *args))
+
+        def land(_):
+            if _flights.get(key) is flight:
+                del _flights[key]
+
+        flight.task.add_done_callback(land)
+    else:
+        _shared_flights += 1
+        raised = priority < flight.priority
+        flight.join(priority, deadline)
+        if raised:
+            # its jobs may be allowed to use reserved workers now
+            _dispatch()
+    flight.waiters += 1
+    try:
+        return await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        if flight.waiters == 1 and not flight.task.done():
+            # let new requests start over instead of joining a cancelled one
+            del _flights[key]
+            flight.task.cancel()
+        raise
+    finally:
+        flight.waiters -= 1
+
+
+async def _fly(flight: Flight, f: Callable, *args) -> Any:
+    # tasks have their own context, this doesn't leak to the caller
+    _current_flight.set(flight)
+    return await f(*args)
+
+
+async def _run_sync(
+    site: str,
+    f: Callable,
+    *args,
+    timeout: Optional[float] = None,
+    priority: Optional[Priority] = None,
+    guild: Optional[int] = None,
+    deadline: Optional[float] = None,
+    hedge: bool = False,
+) -> Any:
+    """Runs f in a worker, limited to `timeout` seconds
+    (EXTRACTION_TIMEOUT by default)
+    Raises SongError if it doesn't start before `deadline`
+    Priority, guild and deadline are inherited from the current flight
+    if not given
+    With `hedge`, f may also run in another worker if it's slow,
+    so it must not have side effects"""
+    if timeout is None:
+        timeout = config.EXTRACTION_TIMEOUT
+    flight = _current_flight.get()
+    if priority is None:
+        priority = Priority.BACKGROUND if flight else Priority.INTERACTIVE
+    if deadline is None:
+        deadline = -math.inf if flight else math.inf
+    if guild is None and flight:
+        guild = flight.guild
+    job = Job(site, f, args, timeout, priority, guild, deadline)
+    _pending.append(job)
+    _dispatch()
+    try:
+        if hedge and config.HEDGE_PERCENTILE:
+            return await _hedge(job)
+        return await job.future
+    except asyncio.CancelledError:
+        # nobody needs the result anymore
+        if job in _pending:
+            _pending.remove(job)
+        raise
+
+
+def _hedge_delay(site: str) -> Optional[float]:
+    "Returns how long jobs from the site run before they are copied"
+    samples = _latencies.get(site, ())
+    if len(samples) < MIN_LATENCY_SAMPLES:
+        return None
+    samples = sorted(samples)
+    return samples[(len(samples) - 1) * config.HEDGE_PERCENTILE // 100]
+
+
+async def _hedge(job: Job) -> Any:
+    """Waits for the job, starting its copy on another worker if it runs
+    unusually long, returns the first successful result"""
+    global _hedges, _hedge_wins
+    delay = _hedge_delay(job.site)
+    # wait until the job has run for the delay
+    while delay is not None and job.priority < Priority.BACKGROUND:
+        if job.started_at is None:
+            timeout = delay
+        else:
+            timeout = job.started_at + delay - time.monotonic()
+            if timeout <= 0:
+                break
+        await asyncio.wait((job.future,), timeout=timeout)
+        if job.future.done():
+            return job.future.result()
+    else:
+        # not worth copying
+        return await job.future
+
+    if _hedges >= config.HEDGE_BUDGET * _finished_jobs:
+        return await job.future
+    copy = Job(
+        job.site,
+        job.func,
+        job.args,
+        job.timeout,
+        job._priority,
+        job.guild,
+        job._deadline,
+    )
+    _pending.appendleft(copy)
+    _dispatch()
+    if copy in _pending:
+        # no free worker, it would only slow others down
+        _pending.remove(copy)
+        return await job.future
+
+    _hedges += 1
+    try:
+        racers = {job.future, copy.future}
+        while True:
+            done, racers = await asyncio.wait(
+                racers, return_when=asyncio.FIRST_COMPLETED
+            )
+            winner = done.pop()
+            if not winner.exception() or not racers:
+                break
+        if winner is copy.future and not winner.exception():
+            _hedge_wins += 1
+        return winner.result()
+    finally:
+        # the loser's result is dropped
+        for racer in (job, copy):
+            if not racer.future.done():
+                racer.future.cancel()
@@ -1,5 +1,5 @@
 import random
-from typing import Optional
+from typing import Dict, Hashable, Optional
 from collections import deque
 
 from discord import Embed
@@ -36,6 +36,10 @@ class Playlist:
 
         self.loop = LoopMode.OFF
 
+        # numbers of songs of playlists that will be queued later,
+        # by their streams, None if unknown
+        self.pending: Dict[Hashable, Optional[int]] = {}
+
     def __len__(self):
         return len(self.playque)
 
@@ -78,6 +82,18 @@ class Playlist:
 
         return self.playque[0]
 
+    def peek_next(self) -> Optional[Song]:
+        "Returns the song next() would return, without moving to it"
+        if len(self.playque) == 0:
+            return None
+        if self.loop == LoopMode.SINGLE:
+            return self.playque[0]
+        if len(self.playque) > 1:
+            return self.playque[1]
+        if self.loop == LoopMode.ALL:
+            return self.playque[0]
+        return None
+
     def prev(self) -> Optional[Song]:
         if self.loop != LoopMode.ALL:
             if len(self.playhistory) != 0:
@@ -133,7 +149,16 @@ class Playlist:
         self.playhistory.clear()
 
     def queue_embed(self) -> Embed:
-        return songs_embed(
+        embed = songs_embed(
             config.QUEUE_TITLE.format(tracks_number=len(self.playque)),
             list(self.playque)[: config.MAX_SONG_PRELOAD],
         )
+        if None in self.pending.values():
+            embed.set_footer(text=config.QUEUE_PENDING_UNKNOWN)
+        elif any(self.pending.values()):
+            embed.set_footer(
+                text=config.QUEUE_PENDING.format(
+                    count=sum(self.pending.values())
+                )
+            )
+        return embed
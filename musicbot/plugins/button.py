@@ -1,7 +1,7 @@
 import discord
 from discord.ext import commands
 from musicbot import linkutils, utils
-from musicbot.bot import MusicBot
+from musicbot.bot import ExtContext, MusicBot
 
 
 SUPPORTED_SITES = (
@@ -77,7 +77,7 @@ class Button(commands.Cog):
 
             audiocontroller = self.bot.audio_controllers[serv]
 
-            ctx = await self.bot.get_context(message)
+            ctx = await self.bot.get_context(message, cls=ExtContext)
             # author is the user who added the reaction,
             # not the one who sent the message
             ctx.author = member
@@ -92,7 +92,7 @@ class Button(commands.Cog):
                     int(sett.command_channel)
                 )
             for url in links:
-                await audiocontroller.process_song(url)
+                await audiocontroller.process_song(url, ctx.deadline)
 
 
 def setup(bot: MusicBot):
@@ -0,0 +1,97 @@
+import time
+from typing import Dict
+
+from config import config
+
+# the rate is never lowered below this fraction of the configured one
+MIN_RATE_FACTOR = 1 / 16
+# fraction of the configured rate restored after every successful request
+RATE_STEP = 1 / 20
+
+
+class SiteLimiter:
+    """Token bucket limiting how often requests to a site are started
+    The rate is halved whenever the site throttles the bot and slowly
+    restored afterwards. Requests are paused for exponentially growing
+    time after consecutive throttlings, and when those keep happening,
+    the circuit opens and requests fail without being tried"""
+
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        # consecutive throttlings
+        self.failures = 0
+        self.throttled = 0
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def is_open(self, now: float) -> bool:
+        "Returns whether requests should fail without being tried"
+        return (
+            self.failures >= config.THROTTLE_CIRCUIT_BREAKER
+            and now < self.paused_until
+        )
+
+    def wait_time(self, now: float) -> float:
+        "Returns seconds until the next request can start"
+        self._refill(now)
+        return max(
+            self.paused_until - now, (1 - self.tokens) / self.rate, 0
+        )
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def success(self):
+        self.failures = 0
+        self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_STEP)
+
+    def throttle(self, now: float):
+        self.failures += 1
+        self.throttled += 1
+        self.rate = max(self.rate / 2, self.max_rate * MIN_RATE_FACTOR)
+        self.tokens = 0
+        pause = config.THROTTLE_BACKOFF * 2 ** (self.failures - 1)
+        self.paused_until = now + min(pause, config.THROTTLE_BACKOFF_MAX)
+
+    def describe(self) -> str:
+        now = time.monotonic()
+        self._refill(now)
+        state = f"{self.rate:.2f}/s, {self.tokens:.1f} tokens"
+        if self.throttled:
+            state += f", throttled {self.throttled} times"
+        if self.is_open(now):
+            state += (
+                f", open (failing fast) for {self.paused_until - now:.0f}s"
+            )
+        elif self.paused_until > now:
+            state += f", paused for {self.paused_until - now:.0f}s"
+        return state
+
+
+_limiters: Dict[str, SiteLimiter] = {}
+
+
+def get_limiter(site: str) -> SiteLimiter:
+    limiter = _limiters.get(site)
+    if limiter is None:
+        limiter = _limiters[site] = SiteLimiter(
+            config.SITE_REQUEST_RATES.get(site, config.SITE_REQUEST_RATE),
+            config.SITE_REQUEST_BURST,
+        )
+    return limiter
+
+
+def stats() -> Dict[str, str]:
+    return {
+        site: limiter.describe() for site, limiter in sorted(_limiters.items())
+    }
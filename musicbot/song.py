@@ -17,6 +17,7 @@ class Song:
         uploader: Optional[str] = None,
         duration: Optional[int] = None,
         thumbnail: Optional[str] = None,
+        acodec: Optional[str] = None,
     ):
         self.host = host
         self.origin = origin
@@ -26,6 +27,8 @@ class Song:
         self.uploader = uploader
         self.duration = duration
         self.thumbnail = thumbnail
+        # codec of the stream URL, as named by yt-dlp
+        self.acodec = acodec
 
     def format_output(self, playtype: str) -> discord.Embed:
         embed = discord.Embed(
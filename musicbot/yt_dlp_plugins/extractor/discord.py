@@ -12,20 +12,21 @@ class DiscordAttachmentsIE(InfoExtractor):
         r"/channels/(?P<guild_id>\d+)/(?P<channel_id>\d+)/(?P<message_id>\d+)"
     )
 
-    def _real_extract(self, url):
-        from musicbot.__main__ import bot
-        from musicbot.loader import _loop
+    @classmethod
+    async def async_extract(cls, url):
+        """Used by the bot instead of extract_info
+        to load attachments without blocking a worker"""
+        from musicbot.loader import get_bot
 
+        bot = get_bot()
         if bot.http.token is None:
-            _loop.run_until_complete(bot.http.static_login(config.BOT_TOKEN))
+            await bot.http.static_login(config.BOT_TOKEN)
 
-        match = re.match(self._VALID_URL, url)
+        match = re.match(cls._VALID_URL, url)
         try:
-            resp = _loop.run_until_complete(
-                bot.http.get_message(
-                    int(match.group("channel_id")),
-                    int(match.group("message_id")),
-                )
+            resp = await bot.http.get_message(
+                int(match.group("channel_id")),
+                int(match.group("message_id")),
             )
         except Exception as e:
             raise DownloadError(str(e)) from e
@@ -40,3 +41,8 @@ class DiscordAttachmentsIE(InfoExtractor):
             for a in resp["attachments"]
         ]
         return {"_type": "playlist", "entries": entries}
+
+    def _real_extract(self, url):
+        from musicbot.loader import _run_coro
+
+        return _run_coro(self.async_extract(url))
@@ -7,13 +7,15 @@ from yt_dlp.extractor.common import InfoExtractor
 class SunoAIIE(InfoExtractor):
     _VALID_URL = r"^https?://(app\.suno\.ai|suno\.com)/song/(?P<code>\w+)"
 
-    def _real_extract(self, url):
-        from musicbot.loader import _loop
+    @classmethod
+    async def async_extract(cls, url):
+        """Used by the bot instead of extract_info
+        to load the page without blocking a worker"""
         from musicbot.linkutils import get_soup
 
-        match = re.match(self._VALID_URL, url)
+        match = re.match(cls._VALID_URL, url)
         try:
-            soup = _loop.run_until_complete(get_soup(url))
+            soup = await get_soup(url)
             return {
                 "id": match.group("code"),
                 "url": soup.find(property="og:audio")["content"],
@@ -22,3 +24,8 @@ class SunoAIIE(InfoExtractor):
             }
         except Exception as e:
             raise DownloadError(str(e)) from e
+
+    def _real_extract(self, url):
+        from musicbot.loader import _run_coro
+
+        return _run_coro(self.async_extract(url))
@@ -0,0 +1,93 @@
+"""Checks switching between Opus and PCM while songs play
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+
+import os
+import time
+import unittest
+
+# config requires a token, the bot never logs in here
+os.environ.setdefault("DISCORD_TOKEN", "")
+
+import discord  # noqa: E402
+import numpy as np  # noqa: E402
+
+from musicbot.audiosource import (  # noqa: E402
+    FRAME_LENGTH,
+    FRAME_SAMPLES,
+    GainTransformer,
+    Playback,
+    SongSource,
+)
+
+# frames in a fake song
+LENGTH = 200
+# left channel of PCM frames
+REFERENCE = 20000
+
+
+class Frames(discord.AudioSource):
+    """Fake ffmpeg output, every frame holds its number
+    In PCM, it's the ratio of the two channels, which survives scaling"""
+
+    def __init__(self, start: int, opus: bool):
+        self.frame = start
+        self.opus = opus
+
+    def read(self) -> bytes:
+        if self.frame >= LENGTH:
+            return b""
+        self.frame += 1
+        if self.opus:
+            return b"opus" + self.frame.to_bytes(4, "big")
+        samples = np.full(FRAME_SAMPLES, REFERENCE, np.int16)
+        samples[1::2] = self.frame * REFERENCE // LENGTH
+        return samples.tobytes()
+
+    def is_opus(self) -> bool:
+        return self.opus
+
+
+class FakeSong(SongSource):
+    "Song that doesn't start ffmpeg"
+
+    def _open(self, volume, position):
+        start = round(position / FRAME_LENGTH)
+        if self._passthrough(volume):
+            return Frames(start, True)
+        return GainTransformer(Frames(start, False), volume)
+
+
+def frame_number(data: bytes, opus: bool) -> int:
+    if opus:
+        return int.from_bytes(data[4:], "big")
+    samples = np.frombuffer(data, np.int16)
+    return round(samples[1] / samples[0] * LENGTH)
+
+
+class PassthroughTest(unittest.TestCase):
+    def test_volume_change_switches_to_pcm(self):
+        playback = Playback(FakeSong("", "opus", 1.0))
+        self.assertTrue(playback.is_opus())
+        numbers = []
+        for _ in range(10):
+            numbers.append(frame_number(playback.read(), playback.is_opus()))
+        playback.volume = 0.5
+        # the song is reopened in the background
+        deadline = time.monotonic() + 5
+        while playback.is_opus() and time.monotonic() < deadline:
+            numbers.append(frame_number(playback.read(), playback.is_opus()))
+            time.sleep(FRAME_LENGTH / 10)
+        self.assertFalse(playback.is_opus())
+        while data := playback.read():
+            self.assertEqual(len(data), FRAME_SAMPLES * 2)
+            numbers.append(frame_number(data, playback.is_opus()))
+        playback.cleanup()
+        # nothing is skipped or repeated by the switch
+        self.assertEqual(numbers, list(range(1, LENGTH + 1)))
+
+
+if __name__ == "__main__":
+    unittest.main()
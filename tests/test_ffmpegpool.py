@@ -0,0 +1,151 @@
+"""Checks that ffmpeg started in advance plays what it's given
+
+Needs ffmpeg, run from the repository root:
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import subprocess
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# config requires a token, the bot never logs in here
+os.environ.setdefault("DISCORD_TOKEN", "")
+
+from config import config  # noqa: E402
+from musicbot import ffmpegpool  # noqa: E402
+from musicbot.audiosource import FRAME_LENGTH, RECONNECT_OPTIONS  # noqa: E402
+
+# seconds of audio in the test file
+LENGTH = 3
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipUnless(shutil.which("ffmpeg"), "ffmpeg is not installed")
+class PoolTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.directory, "sine.wav")
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-f",
+                "lavfi",
+                "-i",
+                f"sine=frequency=440:duration={LENGTH}",
+                "-ac",
+                "2",
+                "-ar",
+                "48000",
+                "-loglevel",
+                "error",
+                cls.path,
+            ],
+            check=True,
+        )
+        # like the files of the audio cache
+        cls.opus_path = os.path.join(cls.directory, "sine.ogg")
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-i",
+                cls.path,
+                "-c:a",
+                "libopus",
+                "-f",
+                "ogg",
+                "-loglevel",
+                "error",
+                cls.opus_path,
+            ],
+            check=True,
+        )
+        cls.server = ThreadingHTTPServer(
+            ("127.0.0.1", 0),
+            partial(QuietHandler, directory=cls.directory),
+        )
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:{}/sine.wav".format(
+            cls.server.server_address[1]
+        )
+        cls.pool_size = config.FFMPEG_POOL_SIZE
+        config.FFMPEG_POOL_SIZE = 1
+
+    @classmethod
+    def tearDownClass(cls):
+        config.FFMPEG_POOL_SIZE = cls.pool_size
+        cls.server.shutdown()
+        shutil.rmtree(cls.directory)
+
+    def frames(self, source: str, before_options: str, opus: bool) -> int:
+        if opus:
+            audio = ffmpegpool.FFmpegOpusAudio(
+                source,
+                codec="opus",
+                before_options=before_options,
+                options="-loglevel error",
+                stderr=sys.stderr,
+            )
+        else:
+            audio = ffmpegpool.FFmpegPCMAudio(
+                source,
+                before_options=before_options,
+                options="-loglevel error",
+                stderr=sys.stderr,
+            )
+        try:
+            count = 0
+            while audio.read():
+                count += 1
+            return count
+        finally:
+            audio.cleanup()
+
+    def wait_for_idle(self):
+        deadline = time.monotonic() + 10
+        while not ffmpegpool.stats()["idle"]:
+            self.assertLess(time.monotonic(), deadline, "nothing started")
+            time.sleep(0.1)
+
+    def check(
+        self,
+        source: str,
+        before_options: str,
+        expected: float,
+        opus: bool = False,
+    ):
+        # starts a process in advance
+        self.frames(source, before_options, opus)
+        self.wait_for_idle()
+        stats = ffmpegpool.stats()
+        frames = self.frames(source, before_options, opus)
+        after = ffmpegpool.stats()
+        self.assertNotEqual(
+            stats["started in advance"], after["started in advance"]
+        )
+        self.assertEqual(stats["started again"], after["started again"])
+        self.assertAlmostEqual(frames * FRAME_LENGTH, expected, delta=0.1)
+
+    def test_file_from_position(self):
+        self.check(self.path, "-ss 1.000", LENGTH - 1)
+
+    def test_saved_opus_from_position(self):
+        self.check(self.opus_path, "-ss 1.000", LENGTH - 1, opus=True)
+
+    def test_stream_with_reconnect_options(self):
+        self.check(self.url, RECONNECT_OPTIONS, LENGTH)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+"""Checks that linkutils.get_ie agrees with a scan over all extractors
+
+Run from the repository root:
+    python -m unittest discover tests
+"""
+
+import os
+import unittest
+
+# config requires a token, the bot never logs in here
+os.environ.setdefault("DISCORD_TOKEN", "")
+
+from musicbot.linkutils import EXTRACTORS, get_ie  # noqa: E402
+
+
+def scan(url):
+    for ie in EXTRACTORS:
+        if ie.suitable(url) and ie.IE_NAME != "generic":
+            return ie
+    return None
+
+
+class GetIETest(unittest.TestCase):
+    def test_extractor_test_urls(self):
+        urls = {
+            test["url"]
+            for ie in EXTRACTORS
+            for test in ie.get_testcases(include_onlymatching=True)
+            if isinstance(test.get("url"), str)
+        }
+        self.assertTrue(urls)
+        for url in sorted(urls):
+            with self.subTest(url=url):
+                self.assertIs(get_ie.__wrapped__(url), scan(url))
+
+
+if __name__ == "__main__":
+    unittest.main()